@@ -0,0 +1,73 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Maximum number of preprocessed questions whose answers are kept (0 disables the cache)
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', 1024))
+
+class AnswerCache:
+    """Bounded LRU cache of chatbot answers keyed on the preprocessed question
+
+    The cache is cleared whenever the FAQ set changes. Every clear starts a
+    new generation, and an answer computed before a clear is not stored
+    after it, so a slow request can't put back a stale answer.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._answers = OrderedDict()
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def __len__(self):
+        return len(self._answers)
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        """Return the cached answer for a preprocessed question, or None"""
+        with self._lock:
+            answer = self._answers.get(key)
+            if answer is None:
+                self._misses += 1
+                return None
+            self._answers.move_to_end(key)
+            self._hits += 1
+            return answer
+
+    def put(self, key, answer, generation=None):
+        """Store an answer, unless the cache was cleared since generation was read"""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._answers[key] = answer
+            self._answers.move_to_end(key)
+            while len(self._answers) > self.max_entries:
+                self._answers.popitem(last=False)
+
+    def clear(self):
+        """Drop every answer after the FAQ set changed"""
+        with self._lock:
+            self._answers.clear()
+            self._generation += 1
+            self._invalidations += 1
+
+    def stats(self):
+        """Report the size of the cache and its hit counters"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._answers),
+                'maxEntries': self.max_entries,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hitRate': self._hits / lookups if lookups else None,
+                'invalidations': self._invalidations
+            }
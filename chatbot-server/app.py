@@ -1,11 +1,19 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from pymongo import MongoClient
+from bson import ObjectId
 import spacy
 import os
+import sys
+from datetime import datetime
 from dotenv import load_dotenv
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from faq_index import FAQIndex
+from answer_cache import AnswerCache
+
+# Modules shared with the face-auth server live in the top-level common package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.collection_sync import CollectionSync
 
 # Load environment variables
 load_dotenv()
@@ -20,79 +28,141 @@ client = MongoClient(mongo_uri)
 db = client.get_database()
 faq_collection = db.faq
 
-# Load spaCy model
+# Ranked alternatives returned with each chatbot answer
+CHATBOT_ALTERNATIVES = int(os.getenv('CHATBOT_ALTERNATIVES', 3))
+# spaCy model used for tokens, stopwords and word vectors
+SPACY_MODEL = os.getenv('SPACY_MODEL', 'en_core_web_md')
+# Pipeline components not loaded: matching only needs the tokenizer and the
+# static word vectors, which don't depend on any component
+SPACY_EXCLUDE = [name for name in os.getenv(
+    'SPACY_EXCLUDE', 'tok2vec,tagger,morphologizer,parser,senter,attribute_ruler,lemmatizer,ner'
+).split(',') if name]
+# Questions processed per batch when the FAQ index is built
+SPACY_BATCH_SIZE = int(os.getenv('SPACY_BATCH_SIZE', 256))
+
+# Load spaCy model without the components matching doesn't use
 try:
-    nlp = spacy.load("en_core_web_md")
-    print("SpaCy model loaded successfully")
-except OSError:
-    print("Downloading SpaCy model...")
-    os.system("python -m spacy download en_core_web_md")
-    nlp = spacy.load("en_core_web_md")
-    print("SpaCy model loaded successfully")
+    nlp = spacy.load(SPACY_MODEL, exclude=SPACY_EXCLUDE)
+    print(f"SpaCy model loaded successfully (pipeline: {nlp.pipe_names})")
+except OSError as e:
+    raise RuntimeError(
+        f"SpaCy model '{SPACY_MODEL}' is not installed. Run: python -m spacy download {SPACY_MODEL}"
+    ) from e
+
+# Tokens of a processed question that are compared: without stopwords and punctuation
+def filter_tokens(doc):
+    return [token for token in doc if not token.is_stop and not token.is_punct]
+
+# Tokens of a question that are compared: lowercase, without stopwords and punctuation
+def question_tokens(text):
+    # Convert to lowercase and process with spaCy
+    return filter_tokens(nlp(text.lower().strip()))
 
 # Preprocess text
 def preprocess_text(text):
-    # Convert to lowercase and process with spaCy
-    doc = nlp(text.lower().strip())
+    return " ".join(token.text for token in question_tokens(text))
+
+# Preprocess a question and compute its vector with a single spaCy call
+def question_vector(text):
+    return tokens_vector(question_tokens(text))
+
+# Preprocess several questions in batches, yielding (processed, vector) in order
+def question_vectors(texts):
+    docs = nlp.pipe((text.lower().strip() for text in texts), batch_size=SPACY_BATCH_SIZE)
+    for doc in docs:
+        yield tokens_vector(filter_tokens(doc))
+
+# Preprocessed text and vector of the compared tokens
+def tokens_vector(tokens):
+    processed = " ".join(token.text for token in tokens)
     
-    # Remove stopwords and punctuation
-    tokens = [token.text for token in doc if not token.is_stop and not token.is_punct]
+    # Same as the vector of the preprocessed text: the mean of its token vectors
+    if tokens:
+        vector = np.mean([token.vector for token in tokens], axis=0)
+    else:
+        vector = np.zeros(nlp.vocab.vectors_length, dtype=np.float32)
     
-    return " ".join(tokens)
+    return processed, vector
 
-# Calculate similarity between two texts
-def calculate_similarity(text1, text2):
-    # Get vector representations
-    doc1 = nlp(text1)
-    doc2 = nlp(text2)
-    
-    # Calculate cosine similarity
-    return doc1.similarity(doc2)
+# Resident index of FAQ question vectors
+faq_index = FAQIndex(question_vector, question_vectors)
 
-# Find best matching question
-def find_best_match(user_question, stored_questions):
-    best_match = None
-    highest_similarity = 0
-    
-    # Preprocess user question
-    processed_user_question = preprocess_text(user_question)
+# Answers to recently asked questions, cleared whenever the FAQ set changes
+answer_cache = AnswerCache()
+
+# Index an FAQ added or updated by this or another worker
+def index_faq(faq):
+    faq_index.upsert(faq)
+    answer_cache.clear()
+
+# Drop a deleted FAQ from the index
+def unindex_faq(faq_id):
+    if faq_index.remove(faq_id):
+        answer_cache.clear()
+
+# Rebuild the index from the whole collection
+def reload_faqs():
+    faq_index.load(faq_collection)
+    answer_cache.clear()
+
+# Keeps the index in sync with FAQ changes made by every worker, following
+# the collection as set by CACHE_SYNC_MODE
+faq_sync = CollectionSync(faq_collection, {'question': 1, 'answer': 1}, index_faq, unindex_faq, reload_faqs)
+try:
+    faq_sync.start()
+except Exception as e:
+    print(f"Error loading FAQ index: {str(e)}")
+
+# Find best matching question, answering repeated questions from the cache
+def find_best_match(user_question):
+    tokens = question_tokens(user_question)
+    processed_user_question = " ".join(token.text for token in tokens)
     
-    # Store all matches and their scores for debugging
-    all_matches = []
+    # Questions that preprocess to the same text always get the same answer
+    generation = answer_cache.generation
+    cached = answer_cache.get(processed_user_question)
+    if cached is not None:
+        print(f"\nUser Question: {user_question}\nCached answer for: {processed_user_question}")
+        return cached
     
-    for question_data in stored_questions:
-        stored_question = question_data["question"]
-        processed_stored_question = preprocess_text(stored_question)
-        
-        # Calculate similarity
-        similarity = calculate_similarity(processed_user_question, processed_stored_question)
-        
-        # Store this match and score
-        all_matches.append({
-            "question": stored_question,
-            "similarity": similarity
-        })
-        
-        if similarity > highest_similarity:
-            highest_similarity = similarity
-            best_match = question_data
+    result = search_best_match(user_question, tokens)
+    answer_cache.put(processed_user_question, result, generation)
+    return result
+
+# Search the FAQ index for the best match of a preprocessed question
+def search_best_match(user_question, tokens):
+    # Retrieve the top matches in one call
+    processed_user_question, vector = tokens_vector(tokens)
+    matches = faq_index.search(processed_user_question, vector, k=max(3, CHATBOT_ALTERNATIVES + 1))
     
-    # Sort matches by similarity for debugging
-    all_matches.sort(key=lambda x: x["similarity"], reverse=True)
+    if not matches:
+        print(f"\nUser Question: {user_question}\nNo FAQs to match against")
+        return None, 0, []
     
     # Print top 3 matches for debugging
     print("\nUser Question:", user_question)
     print("Top matches:")
-    for i, match in enumerate(all_matches[:3]):
-        print(f"{i+1}. {match['question']} (Similarity: {match['similarity']:.2f})")
+    for i, (entry, score) in enumerate(matches[:3]):
+        print(f"{i+1}. {entry['question']} (Similarity: {score:.2f})")
+    
+    best_match, highest_similarity = matches[0]
+    highest_similarity = max(highest_similarity, 0)
+    alternatives = [{'question': entry['question'], 'similarity': score}
+                    for entry, score in matches[1:CHATBOT_ALTERNATIVES + 1] if score > 0]
     
     # Return best match if similarity is above threshold (lowered from 0.8 to 0.7)
     if highest_similarity >= 0.7:
         print(f"Best match found: {best_match['question']} (Similarity: {highest_similarity:.2f})")
-        return best_match, highest_similarity
+        return best_match, highest_similarity, alternatives
     else:
         print(f"No good match found. Highest similarity: {highest_similarity:.2f}")
-        return None, highest_similarity
+        # The closest question is worth suggesting when nothing matched
+        closest = [{'question': best_match['question'], 'similarity': highest_similarity}] if highest_similarity > 0 else []
+        return None, highest_similarity, (closest + alternatives)[:CHATBOT_ALTERNATIVES]
+
+# Filter for an FAQ by id; ids are ObjectIds unless FAQs were inserted with string ids
+def faq_filter(question_id):
+    return {'_id': ObjectId(question_id) if ObjectId.is_valid(question_id) else question_id}
 
 @app.route('/api/chatbot', methods=['POST'])
 def chatbot():
@@ -105,29 +175,28 @@ def chatbot():
             'message': 'Question is required'
         }), 400
     
-    # Get all questions from MongoDB
-    stored_questions = list(faq_collection.find())
-    
-    # Find best match
-    best_match, similarity = find_best_match(user_question, stored_questions)
+    # Find best match in the FAQ index
+    best_match, similarity, alternatives = find_best_match(user_question)
     
     if best_match:
         return jsonify({
             'success': True,
             'answer': best_match['answer'],
             'similarity': float(similarity),
-            'matched_question': best_match['question']
+            'matched_question': best_match['question'],
+            'alternatives': alternatives
         })
     else:
         return jsonify({
             'success': False,
             'answer': 'Contact the administrator for more information.',
-            'similarity': float(similarity)
+            'similarity': float(similarity),
+            'alternatives': alternatives
         })
 
 @app.route('/api/faq', methods=['GET'])
 def get_all_faqs():
-    faqs = list(faq_collection.find({}, {'_id': 0}))
+    faqs = list(faq_collection.find({}, {'_id': 0, 'updatedAt': 0}))
     return jsonify({
         'success': True,
         'data': faqs
@@ -146,10 +215,13 @@ def add_faq():
         }), 400
     
     # Insert new FAQ
-    faq_collection.insert_one({
+    faq = {
         'question': question,
-        'answer': answer
-    })
+        'answer': answer,
+        'updatedAt': datetime.now()
+    }
+    faq_collection.insert_one(faq)
+    index_faq(faq)
     
     return jsonify({
         'success': True,
@@ -170,11 +242,12 @@ def update_faq(question_id):
     
     # Update FAQ
     result = faq_collection.update_one(
-        {'_id': question_id},
-        {'$set': {'question': question, 'answer': answer}}
+        faq_filter(question_id),
+        {'$set': {'question': question, 'answer': answer, 'updatedAt': datetime.now()}}
     )
     
     if result.modified_count > 0:
+        index_faq(dict(faq_filter(question_id), question=question, answer=answer))
         return jsonify({
             'success': True,
             'message': 'FAQ updated successfully'
@@ -188,9 +261,10 @@ def update_faq(question_id):
 @app.route('/api/faq/<question_id>', methods=['DELETE'])
 def delete_faq(question_id):
     # Delete FAQ
-    result = faq_collection.delete_one({'_id': question_id})
+    result = faq_collection.delete_one(faq_filter(question_id))
     
     if result.deleted_count > 0:
+        unindex_faq(faq_filter(question_id)['_id'])
         return jsonify({
             'success': True,
             'message': 'FAQ deleted successfully'
@@ -205,7 +279,10 @@ def delete_faq(question_id):
 def health_check():
     return jsonify({
         'status': 'ok',
-        'message': 'Chatbot server is running'
+        'message': 'Chatbot server is running',
+        'faqs': len(faq_index),
+        'answerCache': answer_cache.stats(),
+        'faqSync': faq_sync.stats()
     })
 
 if __name__ == '__main__':
@@ -335,6 +412,7 @@ if __name__ == '__main__':
         ]
         faq_collection.insert_many(initial_faqs)
         print(f"Added {len(initial_faqs)} initial FAQs to the database")
+        reload_faqs()
     
     # Run the Flask app
     app.run(host='0.0.0.0', port=5002, debug=True) 
\ No newline at end of file
@@ -0,0 +1,181 @@
+import os
+import threading
+import numpy as np
+
+# FAQ count from which searches use the approximate (clustered) index
+FAQ_ANN_MIN_SIZE = int(os.getenv('FAQ_ANN_MIN_SIZE', 2000))
+# Clusters searched per query by the approximate index
+FAQ_ANN_PROBES = int(os.getenv('FAQ_ANN_PROBES', 8))
+
+class FAQIndex:
+    """Resident index of preprocessed FAQ question vectors
+
+    Question vectors are normalized and stacked in one matrix, so a user
+    question is scored against every FAQ with one matrix-vector product.
+    The index is built once at startup and updated when FAQs change; the
+    matrix is rebuilt lazily on the first search after a change.
+
+    From FAQ_ANN_MIN_SIZE questions on, searches are approximate: the
+    vectors are grouped with k-means (about sqrt(N) clusters) and only the
+    FAQ_ANN_PROBES clusters closest to the question are scored.
+    """
+
+    def __init__(self, vectorize, vectorize_many=None, ann_min_size=FAQ_ANN_MIN_SIZE, ann_probes=FAQ_ANN_PROBES):
+        # vectorize(text) returns (preprocessed text, vector); vectorize_many(texts)
+        # yields the same for several texts and is used to build the index
+        self.vectorize = vectorize
+        self.vectorize_many = vectorize_many
+        self.ann_min_size = ann_min_size
+        self.ann_probes = ann_probes
+        self._lock = threading.Lock()
+        self._faqs = {}
+        self._entries = []
+        self._matrix = None
+        self._exact = {}
+        self._centroids = None
+        self._clusters = None
+        self._clustered_size = 0
+        self._dirty = True
+
+    def __len__(self):
+        return len(self._faqs)
+
+    def load(self, collection):
+        """Build the index from every FAQ in the collection"""
+        docs = list(collection.find({}, {'question': 1, 'answer': 1}))
+        if self.vectorize_many is not None:
+            vectors = self.vectorize_many([faq['question'] for faq in docs])
+        else:
+            vectors = (self.vectorize(faq['question']) for faq in docs)
+        faqs = {str(faq['_id']): self._entry(faq, processed, vector)
+                for faq, (processed, vector) in zip(docs, vectors)}
+        with self._lock:
+            self._faqs = faqs
+            self._dirty = True
+        print(f"FAQ index loaded {len(faqs)} questions")
+        return len(faqs)
+
+    def _entry(self, faq, processed, vector):
+        return {
+            '_id': faq['_id'],
+            'question': faq['question'],
+            'answer': faq['answer'],
+            'processed': processed,
+            'vector': np.asarray(vector, dtype=np.float32)
+        }
+
+    def upsert(self, faq):
+        """Add or replace an FAQ"""
+        entry = self._entry(faq, *self.vectorize(faq['question']))
+        with self._lock:
+            self._faqs[str(faq['_id'])] = entry
+            self._dirty = True
+
+    def remove(self, faq_id):
+        """Remove an FAQ, returning whether it was indexed"""
+        with self._lock:
+            removed = self._faqs.pop(str(faq_id), None) is not None
+            self._dirty = self._dirty or removed
+        return removed
+
+    def _snapshot(self):
+        """Return the entries and normalized matrix, rebuilding them after a change"""
+        with self._lock:
+            if self._dirty:
+                entries = list(self._faqs.values())
+                if entries:
+                    matrix = np.stack([entry['vector'] for entry in entries])
+                    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                    # Questions without a vector keep a zero row and score 0
+                    matrix = np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+                else:
+                    matrix = np.empty((0, 0), dtype=np.float32)
+                exact = {}
+                for row, entry in enumerate(entries):
+                    exact.setdefault(entry['processed'], []).append(row)
+                self._entries = entries
+                self._matrix = matrix
+                self._exact = exact
+                self._update_clusters()
+                self._dirty = False
+            return self._entries, self._matrix, self._exact, self._clusters
+
+    def _update_clusters(self):
+        """Assign every row to a cluster of the approximate index
+
+        Clustering is redone only when the index has doubled since it was
+        last clustered; otherwise rows are assigned to the existing
+        centroids, which is one matrix product.
+        """
+        size = len(self._entries)
+        if size < self.ann_min_size:
+            self._centroids = None
+            self._clusters = None
+            return
+
+        if self._centroids is None or size > 2 * self._clustered_size:
+            # Only needed once the FAQ set is large enough for the approximate index
+            from sklearn.cluster import MiniBatchKMeans
+            n_clusters = max(1, int(np.sqrt(size)))
+            kmeans = MiniBatchKMeans(n_clusters=n_clusters, n_init=3, random_state=0).fit(self._matrix)
+            centroids = kmeans.cluster_centers_.astype(np.float32)
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            self._centroids = np.divide(centroids, norms, out=np.zeros_like(centroids), where=norms > 0)
+            self._clustered_size = size
+
+        assignments = np.argmax(self._matrix @ self._centroids.T, axis=1)
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(len(self._centroids) + 1))
+        self._clusters = [order[bounds[c]:bounds[c + 1]] for c in range(len(self._centroids))]
+
+    def scores(self, processed, vector):
+        """Cosine similarity of a preprocessed question to every FAQ, returning (entries, scores)
+
+        Matches spaCy's Doc.similarity: identical preprocessed text scores
+        1.0 and a question without a vector scores 0.
+        """
+        entries, matrix, exact, _ = self._snapshot()
+        if not entries:
+            return entries, np.empty(0, dtype=np.float32)
+        return entries, self._score_rows(matrix, exact, processed, vector, np.arange(len(entries)))
+
+    def _score_rows(self, matrix, exact, processed, vector, rows):
+        """Cosine similarity of a question to the given rows of the matrix"""
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            scores = matrix[rows] @ (vector / norm)
+        else:
+            scores = np.zeros(len(rows), dtype=np.float32)
+
+        # Identical preprocessed text always scores 1.0
+        exact_rows = exact.get(processed)
+        if exact_rows:
+            scores[np.isin(rows, exact_rows)] = 1.0
+        return scores
+
+    def search(self, processed, vector, k=1):
+        """The k FAQs most similar to a preprocessed question, as [(entry, score)] best first
+
+        Exact over the whole index below FAQ_ANN_MIN_SIZE questions,
+        approximate above it.
+        """
+        entries, matrix, exact, clusters = self._snapshot()
+        if not entries or k <= 0:
+            return []
+
+        if clusters is not None and np.linalg.norm(vector) > 0:
+            centroid_scores = self._centroids @ np.asarray(vector, dtype=np.float32)
+            probes = min(self.ann_probes, len(clusters))
+            nearest = np.argpartition(-centroid_scores, probes - 1)[:probes]
+            rows = np.concatenate([clusters[c] for c in nearest] + [np.asarray(exact.get(processed, []), dtype=np.int64)])
+            rows = np.unique(rows)
+        else:
+            rows = np.arange(len(entries))
+
+        scores = self._score_rows(matrix, exact, processed, vector, rows)
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        # Stable order among ties keeps the earliest FAQ first
+        top = top[np.lexsort((rows[top], -scores[top]))]
+        return [(entries[rows[i]], float(scores[i])) for i in top]
@@ -0,0 +1 @@
+"""Modules shared by the face-auth and chatbot servers"""
@@ -0,0 +1,257 @@
+import os
+import threading
+from datetime import datetime, timedelta
+from pymongo.errors import OperationFailure, PyMongoError
+
+# How in-memory indexes follow writes made by other workers and nodes:
+# auto (change streams when the deployment supports them, polling
+# otherwise), changestream, poll or off
+CACHE_SYNC_MODE = os.getenv('CACHE_SYNC_MODE', 'auto')
+# Seconds between polls, and before reconnecting after a change stream error
+CACHE_SYNC_POLL_SECONDS = float(os.getenv('CACHE_SYNC_POLL_SECONDS', 5))
+# Polls also pick up documents stamped this many seconds before the
+# updatedAt high-water mark, allowing for clock skew between workers
+CACHE_SYNC_LAG_SECONDS = float(os.getenv('CACHE_SYNC_LAG_SECONDS', 5))
+# Polls between full id scans, which pick up deletes and inserts made
+# without an updatedAt
+CACHE_SYNC_RECONCILE_POLLS = int(os.getenv('CACHE_SYNC_RECONCILE_POLLS', 12))
+
+class CollectionSync:
+    """Keeps an in-memory index in sync with a MongoDB collection
+
+    Every worker runs one per collection. With change streams (replica sets
+    and sharded clusters), insert, update, replace and delete events are
+    applied as they happen; updates that only touch fields outside the
+    projection, like verification counters, are filtered out by the server.
+    Without change streams, the collection is polled: documents with an
+    updatedAt after the high-water mark are re-indexed on every poll, using
+    an index on updatedAt. Every few polls the full set of ids is compared
+    with the last one, and ids that appeared or disappeared are added or
+    removed.
+
+    start() opens the change stream before the initial load, so no write is
+    missed between the two. Events after an invalidation, or after the
+    stream's history was lost, trigger a full reload.
+    """
+
+    def __init__(self, collection, projection, upsert, remove, reload, mode=CACHE_SYNC_MODE,
+                 poll_seconds=CACHE_SYNC_POLL_SECONDS, lag_seconds=CACHE_SYNC_LAG_SECONDS,
+                 reconcile_polls=CACHE_SYNC_RECONCILE_POLLS):
+        # upsert(document), remove(document id) and reload() update the index
+        self.collection = collection
+        self.projection = projection
+        self.upsert = upsert
+        self.remove = remove
+        self.reload = reload
+        self.mode = mode
+        self.poll_seconds = poll_seconds
+        self.lag = timedelta(seconds=lag_seconds)
+        self.reconcile_polls = max(1, reconcile_polls)
+        self._stop = threading.Event()
+        self._thread = None
+        self._stream = None
+        self._resume_token = None
+        self._loaded = False
+        self._high_water = None
+        self._seen = {}
+        self._ids = None
+        self._polls = 0
+        self._lock = threading.Lock()
+        self._upserts = 0
+        self._removes = 0
+        self._reloads = 0
+        self._errors = 0
+        self._last_sync = None
+
+    def start(self):
+        """Load the index and start following the collection in a background thread"""
+        if self.mode not in ('auto', 'changestream', 'poll', 'off'):
+            raise ValueError(f"Unknown CACHE_SYNC_MODE '{self.mode}', expected auto, changestream, poll or off")
+
+        if self.mode == 'off':
+            self._reload()
+            return self
+
+        # If the database isn't reachable yet, the thread loads the index once it is
+        try:
+            if self.mode == 'poll':
+                self._poll_reload()
+            else:
+                self._connect()
+        finally:
+            self._thread = threading.Thread(target=self._run, name=f'sync-{self.collection.name}', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the background thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.mode == 'poll':
+                    self.poll() if self._loaded else self._poll_reload()
+                    self._stop.wait(self.poll_seconds)
+                else:
+                    self._follow_stream()
+            except Exception as e:
+                self._count('_errors')
+                print(f"Error syncing {self.collection.name}: {str(e)}")
+                self._close_stream()
+                self._stop.wait(self.poll_seconds)
+
+    def _open_stream(self):
+        # Only updates to indexed fields are sent
+        fields = [field for field in self.projection if field != '_id']
+        pipeline = [{'$match': {'$or': [
+            {'operationType': {'$ne': 'update'}},
+            {'updateDescription.removedFields': {'$in': fields}}
+        ] + [{f'updateDescription.updatedFields.{field}': {'$exists': True}} for field in fields]}}]
+        return self.collection.watch(pipeline, full_document='updateLookup',
+                                     resume_after=self._resume_token, max_await_time_ms=1000)
+
+    def _close_stream(self):
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except PyMongoError:
+                pass
+            self._stream = None
+
+    def _connect(self):
+        """Open the change stream, then load the index if it isn't loaded yet"""
+        try:
+            self._stream = self._open_stream()
+        except (OperationFailure, NotImplementedError) as e:
+            if self._resume_token is not None:
+                # The resume token fell off the oplog: start over from a full load
+                print(f"Change stream for {self.collection.name} can't resume, reloading: {str(e)}")
+                self._resume_token = None
+                self._loaded = False
+                self._stream = self._open_stream()
+            elif self.mode == 'auto':
+                # Standalone servers don't support change streams
+                print(f"Change streams unavailable for {self.collection.name}, polling instead: {str(e)}")
+                self.mode = 'poll'
+                self._poll_reload()
+                return
+            else:
+                raise
+        self.mode = 'changestream'
+        if not self._loaded:
+            self._reload()
+
+    def _follow_stream(self):
+        if self._stream is None:
+            self._connect()
+            if self.mode == 'poll':
+                return
+
+        while not self._stop.is_set():
+            change = self._stream.try_next()
+            if change is not None:
+                self._apply(change)
+            self._resume_token = self._stream.resume_token
+            if not self._stream.alive:
+                # Invalidated by a drop or rename
+                self._close_stream()
+                self._resume_token = None
+                return
+
+    def _apply(self, change):
+        operation = change['operationType']
+        if operation in ('insert', 'update', 'replace'):
+            document = change.get('fullDocument')
+            # None when the document was deleted before the lookup; its delete event follows
+            if document is not None:
+                self._upsert(document)
+        elif operation == 'delete':
+            self._remove(change['documentKey']['_id'])
+        elif operation in ('drop', 'rename', 'dropDatabase', 'invalidate'):
+            self._reload()
+
+    def _poll_reload(self):
+        self._ensure_index()
+        # Writes during the load are picked up by the first poll
+        self._high_water = datetime.now()
+        self._reload()
+        self._ids = self._current_ids()
+        self._polls = 0
+
+    def _ensure_index(self):
+        """Index updatedAt so polls don't scan the collection"""
+        try:
+            self.collection.create_index('updatedAt')
+        except OperationFailure as e:
+            # e.g. a read-only user; polling still works, with collection scans
+            print(f"Could not index updatedAt on {self.collection.name}: {str(e)}")
+
+    def poll(self):
+        """Apply documents written since the last poll, and every few polls any inserted or deleted ids"""
+        since = self._high_water - self.lag
+        projection = dict(self.projection, updatedAt=1)
+        applied = set()
+        for document in self.collection.find({'updatedAt': {'$gte': since}}, projection).sort('updatedAt', 1):
+            updated_at = document['updatedAt']
+            # Documents inside the lag window come back on every poll
+            if self._seen.get(document['_id']) == updated_at:
+                continue
+            self._seen[document['_id']] = updated_at
+            self._high_water = max(self._high_water, updated_at)
+            self._upsert(document)
+            applied.add(document['_id'])
+        self._seen = {doc_id: updated_at for doc_id, updated_at in self._seen.items()
+                      if updated_at >= self._high_water - self.lag}
+
+        self._ids |= applied
+        self._polls += 1
+        if self._polls % self.reconcile_polls:
+            self._last_sync = datetime.now()
+            return
+
+        # Deletes leave no updatedAt, and inserts by other tools may not set one
+        ids = self._current_ids()
+        added = ids - self._ids
+        if added:
+            for document in self.collection.find({'_id': {'$in': list(added)}}, self.projection):
+                self._upsert(document)
+        for doc_id in self._ids - ids:
+            self._remove(doc_id)
+        self._ids = ids
+        self._last_sync = datetime.now()
+
+    def _current_ids(self):
+        return {document['_id'] for document in self.collection.find({}, {'_id': 1})}
+
+    def _upsert(self, document):
+        self.upsert(document)
+        self._count('_upserts')
+
+    def _remove(self, doc_id):
+        self.remove(doc_id)
+        self._count('_removes')
+
+    def _reload(self):
+        self.reload()
+        self._loaded = True
+        self._count('_reloads')
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            self._last_sync = datetime.now()
+
+    def stats(self):
+        """Report how the index is kept in sync and how many changes were applied"""
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'upserts': self._upserts,
+                'removes': self._removes,
+                'reloads': self._reloads,
+                'errors': self._errors,
+                'lastSyncAt': self._last_sync.isoformat() if self._last_sync else None
+            }
@@ -54,6 +54,11 @@ export default function ExamAttempt({ exam, onSubmit, onCancel }) {
     const webcamRef = useRef(null);
     const intervalRef = useRef(null);
     const containerRef = useRef(null);
+    const socketRef = useRef(null);
+    const movementHandlerRef = useRef(null);
+    const lastFrameSentAtRef = useRef(0);
+    const frameIntervalRef = useRef(0);
+    const frameSizeRef = useRef(null);
 
     // All constants
     const MAX_WARNINGS = 5;
@@ -62,10 +67,13 @@ export default function ExamAttempt({ exam, onSubmit, onCancel }) {
     const FACE_MISSING_TIMEOUT = 10000; // 10 seconds before exam cancellation
     const MAX_WINDOW_LEAVE_TIME = 5000; // 5 seconds max time allowed away
     const monitoringInterval = 1000; // Check every second
+    const FRAME_TIMER_SLACK = 100; // Timer jitter allowed when following the server's frame interval
     const warmupDurationMs = 3000; // 3 seconds warmup period
     const MOVEMENT_THRESHOLD = 17; // 10% threshold for movement detection
     const MOVEMENT_WARNING_COOLDOWN = 6000; // 3 seconds between movement warnings
     const FLASK_SERVER_URL = process.env.NEXT_PUBLIC_FLASK_URL || 'http://localhost:5001';
+    // Monitoring stream of the async face server; frames go over HTTP when it isn't available
+    const FACE_STREAM_URL = FLASK_SERVER_URL.replace(/^http/, 'ws');
 
     // Timer effect
     useEffect(() => {
@@ -338,6 +346,99 @@ export default function ExamAttempt({ exam, onSubmit, onCancel }) {
         };
     }, []);
 
+    // Handle a movement result, from the monitoring stream or an HTTP response
+    const handleMovementResult = useCallback((data) => {
+        console.log('Response from server:', data);
+        
+        // An overloaded server skipped the frame, which says nothing about
+        // the face; wait the interval it asks for and send the next one
+        if (data.warning === 'server_busy') {
+            frameIntervalRef.current = data.nextIntervalMs || monitoringInterval;
+            return;
+        }
+        
+        // Follow the frame interval and size recommended by the server, which
+        // slows down while the face is stable and speeds up when it moves
+        frameIntervalRef.current = data.nextIntervalMs || monitoringInterval;
+        frameSizeRef.current = data.frameSize || null;
+        
+        // Handle potential undefined data
+        const processedData = {
+            success: data.success || false,
+            warning: data.warning || null,
+            movement: data.movement || 0,
+            rawMovement: data.rawMovement || 0,
+            avgMovement: data.avgMovement || 0,
+            threshold: data.threshold || 0,
+            consecutiveMovements: data.consecutiveMovements || 0,
+            movementDetected: data.movementDetected || false,
+            debug: data.debug || {}
+        };
+        
+        if (processedData.warning === 'face_missing') {
+            handleWarning('Face not detected in camera view', 'face_missing');
+            return;
+        }
+        
+        // Other failures (e.g. processing_error) are the server's, not a
+        // missing face, so they don't count towards the face missing timeout
+        if (!processedData.success) {
+            console.error('Frame not processed:', data.message);
+            return;
+        }
+
+        // Face is detected, reset the timer
+        setFaceMissingStartTime(null);
+        
+        // Check for movement with separate cooldown for movement warnings
+        setDebugInfo(processedData);
+        const movementPercentage = processedData.movement * 100;
+        
+        // Use higher threshold (10%) and check if enough time has passed since last movement warning
+        const now = Date.now();
+        const timeSinceLastMovementWarning = now - lastMovementWarningTime;
+        
+        if (movementPercentage > MOVEMENT_THRESHOLD && timeSinceLastMovementWarning >= MOVEMENT_WARNING_COOLDOWN) {
+            // Update the last movement warning time 
+            setLastMovementWarningTime(now);
+            handleWarning(`Excessive head movement detected (${movementPercentage.toFixed(1)}%). Please keep your head still.`, 'movement');
+        }
+    }, [handleWarning, lastMovementWarningTime]);
+
+    useEffect(() => {
+        movementHandlerRef.current = handleMovementResult;
+    }, [handleMovementResult]);
+
+    // Open one monitoring stream for the exam session once the exam starts;
+    // if it can't connect or closes, frames are posted to /detect-movement
+    useEffect(() => {
+        if (showStartModal || !sessionId) return;
+        
+        const socket = new WebSocket(`${FACE_STREAM_URL}/ws/monitor?sessionId=${encodeURIComponent(sessionId)}`);
+        socket.onopen = () => {
+            console.log('Monitoring stream connected');
+            socketRef.current = socket;
+        };
+        socket.onmessage = (event) => {
+            try {
+                movementHandlerRef.current(JSON.parse(event.data));
+            } catch (error) {
+                console.error('Error monitoring face:', error);
+            }
+        };
+        socket.onclose = () => {
+            if (socketRef.current === socket) {
+                console.log('Monitoring stream closed, sending frames over HTTP');
+                socketRef.current = null;
+            }
+        };
+        
+        return () => {
+            socketRef.current = null;
+            socket.close();
+        };
+    }, [showStartModal, sessionId]);
+
     // Capture and send frames to server for monitoring
     const captureAndSendFrame = useCallback(async () => {
         if (!webcamRef.current || !isMonitoring) {
@@ -345,69 +446,45 @@ export default function ExamAttempt({ exam, onSubmit, onCancel }) {
             return;
         }
 
+        // Skip timer ticks until the interval recommended for this session has passed
+        if (Date.now() - lastFrameSentAtRef.current < frameIntervalRef.current - FRAME_TIMER_SLACK) {
+            return;
+        }
+        lastFrameSentAtRef.current = Date.now();
+
         try {
-            const imageSrc = webcamRef.current.getScreenshot();
+            const imageSrc = webcamRef.current.getScreenshot(frameSizeRef.current || undefined);
             if (!imageSrc) {
                 console.error('No screenshot available');
                 handleWarning('No camera feed available', 'face_missing');
                 return;
             }
 
+            // Send the JPEG bytes directly rather than a base64 data URL inside JSON
+            const frame = await (await fetch(imageSrc)).blob();
+            
+            // Results of streamed frames arrive as messages
+            const socket = socketRef.current;
+            if (socket && socket.readyState === WebSocket.OPEN) {
+                socket.send(frame);
+                return;
+            }
+            
             console.log('Sending frame to server:', FLASK_SERVER_URL);
-            const response = await fetch(`${FLASK_SERVER_URL}/detect-movement`, {
+            const response = await fetch(`${FLASK_SERVER_URL}/detect-movement?sessionId=${encodeURIComponent(sessionId)}`, {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json',
+                    'Content-Type': 'image/jpeg',
                 },
-                body: JSON.stringify({
-                    image: imageSrc,
-                    sessionId: sessionId
-                }),
+                body: frame,
             });
             
-            const data = await response.json();
-            console.log('Response from server:', data);
-            
-            // Handle potential undefined data
-            const processedData = {
-                success: data.success || false,
-                warning: data.warning || null,
-                movement: data.movement || 0,
-                rawMovement: data.rawMovement || 0,
-                avgMovement: data.avgMovement || 0,
-                threshold: data.threshold || 0,
-                consecutiveMovements: data.consecutiveMovements || 0,
-                movementDetected: data.movementDetected || false,
-                debug: data.debug || {}
-            };
-            
-            if (!processedData.success || processedData.warning === 'face_missing') {
-                handleWarning('Face not detected in camera view', 'face_missing');
-                return;
-            }
-
-            // Face is detected, reset the timer
-            setFaceMissingStartTime(null);
-            
-            // Check for movement with separate cooldown for movement warnings
-            setDebugInfo(processedData);
-            const movementPercentage = processedData.movement * 100;
-            
-            // Use higher threshold (10%) and check if enough time has passed since last movement warning
-            const now = Date.now();
-            const timeSinceLastMovementWarning = now - lastMovementWarningTime;
-            
-            if (movementPercentage > MOVEMENT_THRESHOLD && timeSinceLastMovementWarning >= MOVEMENT_WARNING_COOLDOWN) {
-                // Update the last movement warning time 
-                setLastMovementWarningTime(now);
-                handleWarning(`Excessive head movement detected (${movementPercentage.toFixed(1)}%). Please keep your head still.`, 'movement');
-            }
-            
+            handleMovementResult(await response.json());
         } catch (error) {
             console.error('Error monitoring face:', error);
             handleWarning('Error monitoring face', 'face_missing');
         }
-    }, [isMonitoring, sessionId, handleWarning, webcamRef, lastMovementWarningTime]);
+    }, [isMonitoring, sessionId, handleWarning, webcamRef, handleMovementResult]);
 
     // Webcam container dragging functionality
     const handleMouseDown = (e) => {
@@ -0,0 +1,352 @@
+import asyncio
+import contextlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from a2wsgi import WSGIMiddleware
+from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+import app_simplified as face_app
+from features import DECODE_SIZE, base64_to_bytes
+from gallery import GALLERY_PROJECTION
+
+# Run with: uvicorn asgi_app:app --port 5001 --workers 4
+
+# Threads that decode and compare frames off the event loop, per worker
+ASGI_EXECUTOR_WORKERS = int(os.getenv('ASGI_EXECUTOR_WORKERS', os.cpu_count() or 1))
+# Requests being processed or waiting for the executor; further requests
+# get a 503 instead of queueing without bound
+ASGI_MAX_PENDING = int(os.getenv('ASGI_MAX_PENDING', 256))
+# Seconds a client turned away by the limit is asked to wait, sent as Retry-After
+ASGI_RETRY_AFTER_SECONDS = int(os.getenv('ASGI_RETRY_AFTER_SECONDS', 1))
+
+# Origins allowed to call the server, also checked when a monitoring stream
+# connects since browsers don't apply CORS to WebSockets
+ALLOWED_ORIGINS = os.getenv('ALLOWED_ORIGINS', '*').split(',')
+
+# Routes served natively on the event loop; every other request, and
+# multipart uploads, go to the Flask app on a thread
+NATIVE_ROUTES = {
+    ('GET', '/health'),
+    ('POST', '/verify'),
+    ('POST', '/monitor'),
+    ('POST', '/detect-movement'),
+    ('POST', '/check-multiple-faces')
+}
+
+executor = ThreadPoolExecutor(max_workers=ASGI_EXECUTOR_WORKERS, thread_name_prefix='face-work')
+
+# Async client for the per-request reads and writes, opened at startup; the
+# gallery index and its sync still use the app's pymongo client
+mongo_client = None
+face_collection = None
+
+# Requests in flight, requests turned away and open monitoring streams,
+# counted on the event loop thread
+_pending = 0
+_rejected = 0
+_streams = 0
+
+class FaceJSONResponse(JSONResponse):
+    """JSON response encoded like the Flask app's, with NumPy values converted"""
+
+    def render(self, content):
+        return json.dumps(content, cls=face_app.CustomJSONEncoder, sort_keys=True,
+                          separators=(',', ':')).encode('utf-8')
+
+async def run_blocking(func, *args):
+    """Run CPU-bound or blocking work on the bounded executor"""
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+def parse_image_body(mimetype, body, query, size, grayscale):
+    """(fields, image) of a raw image or JSON request body, like read_image_request"""
+    if mimetype in face_app.RAW_IMAGE_TYPES:
+        return dict(query), face_app.frame_pool.decode(body, size, grayscale) if body else None
+
+    if mimetype != 'application/json':
+        raise ValueError("415 Unsupported Media Type: Did not attempt to load JSON data because the request "
+                         "Content-Type was not 'application/json'.")
+    data = json.loads(body) if body else None
+    if not data:
+        return {}, None
+    fields = {key: value for key, value in data.items() if key != 'image'}
+    return fields, face_app.frame_pool.decode(base64_to_bytes(data['image']), size, grayscale) if 'image' in data else None
+
+def parse_session_id(mimetype, body, query):
+    """sessionId of a raw image or JSON request body, without decoding its image"""
+    if mimetype in face_app.RAW_IMAGE_TYPES:
+        return query.get('sessionId')
+    try:
+        data = json.loads(body) if mimetype == 'application/json' and body else None
+    except ValueError:
+        return None
+    return data.get('sessionId') if isinstance(data, dict) else None
+
+async def read_image_request(request, size=DECODE_SIZE, grayscale=True):
+    """Read a request body without blocking the loop, then decode it on the executor
+
+    With FRAME_POOL_WORKERS set, the executor thread hands the decode to the
+    frame pool's processes.
+    """
+    body = await request.body()
+    mimetype = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    return await run_blocking(parse_image_body, mimetype, body, request.query_params, size, grayscale)
+
+async def get_or_load(user_id):
+    """gallery.get_or_load with the database lookup made through the async driver"""
+    entry, lookup = face_app.gallery.cached(user_id)
+    if not lookup:
+        return entry
+    face_data = await face_collection.find_one({'userId': user_id}, GALLERY_PROJECTION)
+    return await run_blocking(face_app.gallery.add_lookup, user_id, face_data)
+
+def busy_data():
+    """Response data for a request turned away by admission control
+
+    The server_busy warning tells clients the frame wasn't looked at, so it
+    says nothing about the face, and nextIntervalMs spaces out the next one.
+    """
+    return {
+        'success': False,
+        'message': 'Server busy, try again shortly',
+        'warning': 'server_busy',
+        'nextIntervalMs': ASGI_RETRY_AFTER_SECONDS * 1000
+    }
+
+async def respond(name, handler, warning=None):
+    """Run a route handler with admission control and the Flask app's error responses"""
+    global _pending, _rejected
+    if _pending >= ASGI_MAX_PENDING:
+        _rejected += 1
+        return FaceJSONResponse(busy_data(), 503, headers={'Retry-After': str(ASGI_RETRY_AFTER_SECONDS)})
+
+    _pending += 1
+    try:
+        return await handler()
+    except Exception as e:
+        print(f"Error in {name}: {str(e)}")
+        response_data = {
+            'success': False,
+            'message': f'Error processing request: {str(e)}'
+        }
+        if warning:
+            response_data['warning'] = warning
+        return FaceJSONResponse(response_data, 500)
+    finally:
+        _pending -= 1
+
+def executor_stats():
+    """Report the executor size, admission counters and open streams"""
+    return {
+        'executorWorkers': ASGI_EXECUTOR_WORKERS,
+        'maxPending': ASGI_MAX_PENDING,
+        'pending': _pending,
+        'rejected': _rejected,
+        'streams': _streams
+    }
+
+async def health_check(request):
+    """Health check endpoint"""
+    async def handler():
+        response_data = await run_blocking(face_app.health_data)
+        response_data['asgi'] = executor_stats()
+        return FaceJSONResponse(response_data, 200)
+    return await respond('health_check', handler)
+
+async def verify_face(request):
+    """Verify a face against the registered faces"""
+    async def handler():
+        data, image = await read_image_request(request, face_app.engine.decode_size, face_app.engine.grayscale)
+
+        if image is None:
+            return FaceJSONResponse({
+                'success': False,
+                'message': 'Missing required field: image'
+            }, 400)
+
+        user_id = data.get('userId')
+        if user_id:
+            await get_or_load(user_id)
+
+        response_data, status, verified_id = await run_blocking(face_app.verification_result, user_id, image)
+
+        # Update verification stats
+        if verified_id is not None:
+            await face_collection.update_one({'_id': verified_id}, face_app.verification_update())
+
+        return FaceJSONResponse(response_data, status)
+    return await respond('verify_face', handler)
+
+async def monitor_face(request):
+    """Monitor a face during an exam"""
+    async def handler():
+        data, image = await read_image_request(request, face_app.engine.decode_size, face_app.engine.grayscale)
+
+        if image is None or 'userId' not in data:
+            return FaceJSONResponse({
+                'success': False,
+                'message': 'Missing required fields: image and userId'
+            }, 400)
+
+        user_face = await get_or_load(data['userId'])
+
+        if not user_face:
+            return FaceJSONResponse({
+                'success': False,
+                'message': f'No face registered for user {data["userId"]}',
+                'warning': 'not_registered'
+            }, 200)
+
+        return FaceJSONResponse(*await run_blocking(face_app.monitoring_result, data, image))
+    return await respond('monitor_face', handler, 'processing_error')
+
+async def detect_movement(request):
+    """Detect head movement between frames"""
+    async def handler():
+        # Frames arriving before the recommended interval skip decoding
+        state = None
+        if face_app.frame_cadence.cached_verdicts:
+            mimetype = request.headers.get('content-type', '').split(';')[0].strip().lower()
+            session_id = await run_blocking(parse_session_id, mimetype, await request.body(), request.query_params)
+            state, verdict = await run_blocking(face_app.cached_movement, session_id)
+            if verdict is not None:
+                return FaceJSONResponse(verdict, 200)
+
+        data, image = await read_image_request(request)
+
+        if image is None or 'sessionId' not in data:
+            return FaceJSONResponse({
+                'success': False,
+                'message': 'Missing required fields: image and sessionId'
+            }, 400)
+
+        return FaceJSONResponse(*await run_blocking(face_app.movement_result, data, image, state))
+    return await respond('detect_movement', handler, 'processing_error')
+
+async def check_multiple_faces(request):
+    """Check if multiple faces are present in the image"""
+    async def handler():
+        _, image = await read_image_request(request, face_app.engine.decode_size, face_app.engine.grayscale)
+
+        if image is None:
+            return FaceJSONResponse({
+                'success': False,
+                'message': 'Missing required field: image'
+            }, 400)
+
+        return FaceJSONResponse(*await run_blocking(face_app.face_count_result, image))
+    return await respond('check_multiple_faces', handler)
+
+def stream_frame_result(state, frame):
+    """Decode one streamed frame and compare it with the previous one, like movement_result"""
+    verdict = face_app.frame_cadence.cached(state)
+    if verdict is not None:
+        return verdict
+    image = face_app.frame_pool.decode(frame, DECODE_SIZE, True)
+    return face_app.movement_update(state, image)[0]
+
+async def stream_monitoring(websocket):
+    """Movement detection over one WebSocket per exam session
+
+    The client connects to /ws/monitor?sessionId=... and sends each frame
+    as a binary message (JPEG, PNG or WebP bytes). The server answers every
+    frame with a JSON message shaped like a /detect-movement response plus
+    the frame number, so warnings reach the client as soon as a frame
+    triggers them. The session's movement state stays with the connection
+    and is saved to the session store when it closes, so the session can
+    continue over HTTP or a new connection.
+    """
+    global _streams, _pending, _rejected
+    session_id = websocket.query_params.get('sessionId')
+    origin = websocket.headers.get('origin')
+    if not session_id or ('*' not in ALLOWED_ORIGINS and origin not in ALLOWED_ORIGINS):
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    state = await run_blocking(face_app.session_store.get, session_id) or face_app.new_movement_state()
+    _streams += 1
+    frames = 0
+    try:
+        while True:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+            frame = message.get('bytes')
+            if frame is None:
+                # Only binary frames are accepted
+                await websocket.close(code=1003)
+                break
+            frames += 1
+            if _pending >= ASGI_MAX_PENDING:
+                # Skip the frame rather than queue it; the next one replaces it
+                _rejected += 1
+                response_data = busy_data()
+            else:
+                _pending += 1
+                try:
+                    response_data = await run_blocking(stream_frame_result, state, frame)
+                except Exception as e:
+                    print(f"Error in stream_monitoring: {str(e)}")
+                    response_data = {
+                        'success': False,
+                        'message': f'Error processing request: {str(e)}',
+                        'warning': 'processing_error'
+                    }
+                finally:
+                    _pending -= 1
+            response_data['frame'] = frames
+            await websocket.send_text(FaceJSONResponse(response_data).body.decode('utf-8'))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        _streams -= 1
+        if state['features'] is not None:
+            await run_blocking(face_app.session_store.put, session_id, state)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Database clients, the gallery and the workers start with the server
+    # rather than on import
+    global mongo_client, face_collection
+    face_app.create_app()
+    mongo_client = AsyncIOMotorClient(face_app.mongo_uri)
+    face_collection = mongo_client[face_app.db_name][face_app.collection_name]
+    yield
+    mongo_client.close()
+    executor.shutdown(wait=False)
+
+native_app = Starlette(
+    routes=[
+        Route('/health', health_check, methods=['GET']),
+        Route('/verify', verify_face, methods=['POST']),
+        Route('/monitor', monitor_face, methods=['POST']),
+        Route('/detect-movement', detect_movement, methods=['POST']),
+        Route('/check-multiple-faces', check_multiple_faces, methods=['POST']),
+        WebSocketRoute('/ws/monitor', stream_monitoring)
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=ALLOWED_ORIGINS,
+                           allow_methods=['*'], allow_headers=['*'], max_age=600)],
+    lifespan=lifespan
+)
+
+# Registration, deletion and CORS preflight requests run the Flask views on threads
+flask_app = WSGIMiddleware(face_app.app, workers=ASGI_EXECUTOR_WORKERS)
+
+async def app(scope, receive, send):
+    """ASGI entry point: monitoring routes and streams on the event loop, the rest through Flask"""
+    if scope['type'] == 'http':
+        content_type = dict(scope['headers']).get(b'content-type', b'')
+        if (scope['method'], scope['path']) not in NATIVE_ROUTES or content_type.startswith(b'multipart/'):
+            await flask_app(scope, receive, send)
+            return
+    await native_app(scope, receive, send)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.getenv('PORT', 5001)))
@@ -0,0 +1,55 @@
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
+from features import FEATURE_SIZE
+
+# Shifts simulating position changes, in pixels of the registration image
+VARIATION_SHIFTS = [(5, 0), (-5, 0), (0, 5), (0, -5)]
+# Small rotations in degrees
+VARIATION_ANGLES = [2, -2]
+# Cutoff used for the higher contrast variation
+AUTOCONTRAST_CUTOFF = 3
+# Brightness factor used for the darker variation
+DARKER_FACTOR = 0.95
+# Original + shifts + rotations + brighter + darker
+VARIATION_COUNT = 1 + len(VARIATION_SHIFTS) + len(VARIATION_ANGLES) + 2
+
+def _blur(pixels):
+    """Apply the comparison blur to a 64x64 uint8 array"""
+    image = Image.fromarray(pixels).filter(ImageFilter.GaussianBlur(radius=1.0))
+    return np.array(image)
+
+def generate_variations(image):
+    """Create the registration variations of an image as 64x64 uint8 pixel arrays
+
+    The image is reduced to the comparison size first and every variation
+    is derived at 64x64, with shifts scaled to match the original image
+    size. Variation 0 is the original image. Returns a (VARIATION_COUNT,
+    64, 64) array.
+    """
+    scale_x = FEATURE_SIZE / image.width
+    scale_y = FEATURE_SIZE / image.height
+    base = image.resize((FEATURE_SIZE, FEATURE_SIZE)).convert('L')
+    variations = [base]
+
+    # Slightly shifted to simulate position changes, with a black border
+    for dx, dy in VARIATION_SHIFTS:
+        variations.append(base.transform(base.size, Image.AFFINE,
+                                         (1, 0, -dx * scale_x, 0, 1, -dy * scale_y),
+                                         resample=Image.BILINEAR))
+
+    # Small rotation variations
+    for angle in VARIATION_ANGLES:
+        variations.append(base.rotate(angle, resample=Image.BICUBIC, expand=False))
+
+    # Slightly higher contrast
+    variations.append(ImageOps.autocontrast(base, cutoff=AUTOCONTRAST_CUTOFF))
+
+    pixels = np.empty((VARIATION_COUNT, FEATURE_SIZE, FEATURE_SIZE), dtype=np.uint8)
+    pixels[:-1] = np.stack([np.array(v) for v in variations])
+    # Slightly darker
+    pixels[-1] = (pixels[0] * DARKER_FACTOR).astype(np.uint8)
+
+    for v in range(VARIATION_COUNT):
+        pixels[v] = _blur(pixels[v])
+
+    return pixels
@@ -0,0 +1,94 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+
+# Most frames scored together in one batch
+FRAME_BATCH_MAX_SIZE = int(os.getenv('FRAME_BATCH_MAX_SIZE', 64))
+# How long the first frame of a batch waits for others, in milliseconds
+# (0 scores every frame on its own request thread)
+FRAME_BATCH_WAIT_MS = float(os.getenv('FRAME_BATCH_WAIT_MS', 0))
+
+class MicroBatcher:
+    """Coalesces scoring calls from concurrent requests into stacked batches
+
+    Request threads call submit() and block on the result. A background
+    thread takes the first waiting call, gathers any others arriving within
+    max_wait (up to max_batch_size), scores them with one call to
+    batch_fn and hands each request its own result.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=FRAME_BATCH_MAX_SIZE, max_wait_ms=FRAME_BATCH_WAIT_MS):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._largest = 0
+        self._thread = None
+        if self.enabled:
+            self._thread = threading.Thread(target=self._run, name='frame-batcher', daemon=True)
+            self._thread.start()
+
+    @property
+    def enabled(self):
+        return self.max_wait > 0 and self.max_batch_size > 1
+
+    def submit(self, *args):
+        """Score one set of arguments, batched with other concurrent calls"""
+        if not self.enabled:
+            self._record(1)
+            return self.batch_fn(*[np.asarray(arg)[np.newaxis] for arg in args])[0]
+
+        future = Future()
+        self._queue.put((args, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                stacked = [np.stack(column) for column in zip(*(args for args, _ in batch))]
+                results = self.batch_fn(*stacked)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self._record(len(batch))
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def _record(self, size):
+        with self._lock:
+            self._batches += 1
+            self._items += size
+            self._largest = max(self._largest, size)
+
+    def stats(self):
+        """Report batch counters"""
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'maxBatchSize': self.max_batch_size,
+                'maxWaitMs': self.max_wait * 1000,
+                'batches': self._batches,
+                'items': self._items,
+                'averageBatchSize': self._items / self._batches if self._batches else 0,
+                'largestBatch': self._largest,
+                'queued': self._queue.qsize()
+            }
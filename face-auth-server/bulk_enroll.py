@@ -0,0 +1,83 @@
+import argparse
+import csv
+import os
+import sys
+import tarfile
+from db import db, face_collection
+from enrollment import BULK_WRITE_SIZE, ENROLL_WORKERS, RAW_IMAGE_COLLECTION, STORE_RAW_IMAGES, enroll
+
+# File extensions treated as face photos
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+def load_manifest(path):
+    """Read a CSV manifest with filename, userId and name columns"""
+    with open(path, newline='') as f:
+        return {row['filename']: row for row in csv.DictReader(f)}
+
+def _record(filename, image_bytes, manifest):
+    """Build an enrollment record, taking userId and name from the manifest or file name"""
+    key = os.path.basename(filename)
+    if manifest is not None:
+        row = manifest.get(key) or manifest.get(filename)
+        if row is None:
+            return None
+        return {'userId': row['userId'], 'name': row.get('name') or row['userId'], 'imageBytes': image_bytes}
+
+    user_id = os.path.splitext(key)[0]
+    return {'userId': user_id, 'name': user_id, 'imageBytes': image_bytes}
+
+def iter_records(source, manifest=None):
+    """Yield enrollment records from a directory or tarball of photos"""
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for filename in sorted(files):
+                if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                path = os.path.join(root, filename)
+                with open(path, 'rb') as f:
+                    record = _record(os.path.relpath(path, source), f.read(), manifest)
+                if record is not None:
+                    yield record
+    else:
+        with tarfile.open(source) as tar:
+            for member in tar:
+                if not member.isfile() or not member.name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                record = _record(member.name, tar.extractfile(member).read(), manifest)
+                if record is not None:
+                    yield record
+
+def main():
+    parser = argparse.ArgumentParser(description='Enroll face photos from a directory or tarball')
+    parser.add_argument('source', help='Directory or tarball of face photos')
+    parser.add_argument('--manifest', help='CSV with filename,userId,name columns '
+                                           '(default: userId and name from the file name)')
+    parser.add_argument('--workers', type=int, default=ENROLL_WORKERS,
+                        help='Worker processes for decoding (default: one per core)')
+    parser.add_argument('--batch-size', type=int, default=BULK_WRITE_SIZE,
+                        help='Faces written per bulk_write call')
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.manifest) if args.manifest else None
+
+    print(f"Enrolling faces from {args.source}...")
+    enrolled = 0
+    failures = []
+    raw_images = db[RAW_IMAGE_COLLECTION] if STORE_RAW_IMAGES else None
+    for result in enroll(face_collection, iter_records(args.source, manifest), args.workers, args.batch_size,
+                         raw_images):
+        if result['success']:
+            enrolled += 1
+        else:
+            failures.append(result)
+            print(f"Failed to enroll {result['userId']}: {result['message']}")
+
+        processed = enrolled + len(failures)
+        if processed % 100 == 0:
+            print(f"Processed {processed} faces ({enrolled} enrolled, {len(failures)} failed)")
+
+    print(f"Enrollment complete: {enrolled} enrolled, {len(failures)} failed")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import math
+import os
+import threading
+import time
+
+# Frame interval recommended while the face moves, after a warning and at
+# the start of a session, in milliseconds (the exam page's original cadence)
+CADENCE_MIN_INTERVAL_MS = int(os.getenv('CADENCE_MIN_INTERVAL_MS', 1000))
+# Longest interval recommended for a stable face, in milliseconds
+CADENCE_MAX_INTERVAL_MS = int(os.getenv('CADENCE_MAX_INTERVAL_MS', 5000))
+# Factor the interval grows by with each further stable frame
+CADENCE_BACKOFF = float(os.getenv('CADENCE_BACKOFF', 1.5))
+# Smoothed movement below which a frame without warnings counts as stable
+CADENCE_STABLE_MOVEMENT = float(os.getenv('CADENCE_STABLE_MOVEMENT', 0.05))
+# Stable frames in a row before the small frame size is recommended
+CADENCE_SMALL_FRAME_AFTER = int(os.getenv('CADENCE_SMALL_FRAME_AFTER', 3))
+# Frame sizes recommended for a moving and for a stable face, as WIDTHxHEIGHT
+CADENCE_FRAME_SIZE = os.getenv('CADENCE_FRAME_SIZE', '256x144')
+CADENCE_SMALL_FRAME_SIZE = os.getenv('CADENCE_SMALL_FRAME_SIZE', '128x72')
+# Frames per second this worker aims to stay under across all sessions;
+# above it, every recommended interval is stretched (0 ignores the load)
+CADENCE_TARGET_FPS = float(os.getenv('CADENCE_TARGET_FPS', 0))
+# Answer frames that arrive before the recommended interval with the
+# session's last stable verdict instead of processing them
+CADENCE_CACHED_VERDICTS = os.getenv('CADENCE_CACHED_VERDICTS', 'false').lower() == 'true'
+# Frames up to this early are still processed, allowing for timer jitter, in milliseconds
+CADENCE_EARLY_TOLERANCE_MS = int(os.getenv('CADENCE_EARLY_TOLERANCE_MS', 200))
+
+def parse_size(size):
+    """{'width': ..., 'height': ...} of a WIDTHxHEIGHT string"""
+    width, height = size.lower().split('x')
+    return {'width': int(width), 'height': int(height)}
+
+class CadenceController:
+    """Recommends when, and at what size, a session sends its next frame
+
+    Each movement response gets a nextIntervalMs and a frameSize. A session
+    starts at the minimum interval and full frame size. Every stable frame
+    (low smoothed movement, no warning) stretches the interval by the
+    backoff factor up to the maximum, and after a few stable frames the
+    small frame size is recommended. Any movement or warning returns the
+    session to the minimum interval and full size at once.
+
+    When the worker processes more frames per second than the target, every
+    interval is stretched by the overload factor.
+
+    With cached verdicts, a frame that arrives before the interval its
+    session was given is answered with the last stable verdict, without
+    decoding or comparing it. Verdicts with warnings are never replayed.
+    """
+
+    def __init__(self, min_interval_ms=CADENCE_MIN_INTERVAL_MS, max_interval_ms=CADENCE_MAX_INTERVAL_MS,
+                 backoff=CADENCE_BACKOFF, stable_movement=CADENCE_STABLE_MOVEMENT,
+                 small_frame_after=CADENCE_SMALL_FRAME_AFTER, frame_size=CADENCE_FRAME_SIZE,
+                 small_frame_size=CADENCE_SMALL_FRAME_SIZE, target_fps=CADENCE_TARGET_FPS,
+                 cached_verdicts=CADENCE_CACHED_VERDICTS, early_tolerance_ms=CADENCE_EARLY_TOLERANCE_MS):
+        self.min_interval_ms = min_interval_ms
+        self.max_interval_ms = max(max_interval_ms, min_interval_ms)
+        self.backoff = backoff
+        self.stable_movement = stable_movement
+        self.small_frame_after = small_frame_after
+        self.frame_size = parse_size(frame_size)
+        self.small_frame_size = parse_size(small_frame_size)
+        self.target_fps = target_fps
+        self.cached_verdicts = cached_verdicts
+        self.early_tolerance_ms = early_tolerance_ms
+        # Stable frames after which the backoff reaches the maximum interval;
+        # the exponent stops there so long stable runs can't overflow
+        self._backoff_steps = (math.ceil(math.log(self.max_interval_ms / min_interval_ms) / math.log(backoff))
+                               if backoff > 1 and min_interval_ms > 0 else 0)
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_frames = 0
+        self._frame_rate = 0.0
+        self._frames = 0
+        self._stable = 0
+        self._cached = 0
+
+    def _count_frame(self):
+        """Count a processed frame, keeping the frame rate over one-second windows"""
+        now = time.monotonic()
+        with self._lock:
+            self._frames += 1
+            self._window_frames += 1
+            elapsed = now - self._window_start
+            if elapsed >= 1.0:
+                self._frame_rate = self._window_frames / elapsed
+                self._window_start = now
+                self._window_frames = 0
+
+    def load(self):
+        """Processed frames per second relative to the target (0 without a target)"""
+        with self._lock:
+            return self._frame_rate / self.target_fps if self.target_fps > 0 else 0.0
+
+    def advise(self, state, response_data):
+        """Add nextIntervalMs and frameSize to a movement response, updating the session's state
+
+        A cached copy of stable responses is kept in the state, so call
+        this once the response is complete.
+        """
+        self._count_frame()
+        stable = (response_data['success'] and 'rawMovement' in response_data
+                  and response_data['warning'] in (None, 'null') and not response_data['movementDetected']
+                  and response_data['movement'] < self.stable_movement)
+        stable_frames = state.get('stableFrames', 0) + 1 if stable else 0
+        state['stableFrames'] = stable_frames
+
+        interval = self.min_interval_ms * self.backoff ** min(stable_frames, self._backoff_steps)
+        load = self.load()
+        if load > 1:
+            interval *= load
+        interval = int(min(interval, self.max_interval_ms))
+
+        response_data['nextIntervalMs'] = interval
+        response_data['frameSize'] = dict(self.small_frame_size if stable_frames >= self.small_frame_after
+                                          else self.frame_size)
+
+        state['nextFrameAt'] = time.time() + (interval - self.early_tolerance_ms) / 1000.0
+        if stable:
+            self._count('_stable')
+        if self.cached_verdicts and stable:
+            state['verdict'] = dict(response_data)
+        else:
+            state.pop('verdict', None)
+
+    def cached(self, state):
+        """The session's last stable verdict if its next frame isn't due yet, else None"""
+        if not self.cached_verdicts or not state or state.get('verdict') is None:
+            return None
+        remaining = state['nextFrameAt'] - time.time()
+        if remaining <= 0:
+            return None
+
+        self._count('_cached')
+        verdict = dict(state['verdict'])
+        verdict['cached'] = True
+        # Realign the client with the interval it was given
+        verdict['nextIntervalMs'] = int(remaining * 1000) + self.early_tolerance_ms
+        return verdict
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        """Report the frame rate, load and how many frames were stable or answered from cache"""
+        with self._lock:
+            return {
+                'targetFps': self.target_fps,
+                'frameRate': self._frame_rate,
+                'load': self._frame_rate / self.target_fps if self.target_fps > 0 else None,
+                'frames': self._frames,
+                'stableFrames': self._stable,
+                'cachedVerdicts': self._cached if self.cached_verdicts else None
+            }
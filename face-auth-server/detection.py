@@ -0,0 +1,79 @@
+import os
+import threading
+import numpy as np
+from PIL import Image
+
+# Face detector for engines without their own: cascade (OpenCV Haar
+# cascade, used when OpenCV is installed) or none
+FACE_DETECTOR = os.getenv('FACE_DETECTOR', 'cascade')
+# Frames are downscaled to fit this size before detection
+DETECTOR_FRAME_SIZE = (320, 240)
+# Smallest face reported, in pixels of the downscaled frame
+DETECTOR_MIN_FACE = int(os.getenv('DETECTOR_MIN_FACE', 30))
+# Scale step between cascade passes and detections needed to report a face
+DETECTOR_SCALE_FACTOR = 1.2
+DETECTOR_MIN_NEIGHBORS = 5
+# Cascade shipped with OpenCV
+CASCADE_FILE = 'haarcascade_frontalface_default.xml'
+
+class CascadeFaceDetector:
+    """Haar cascade face detection on downscaled grayscale frames
+
+    Every frame is reduced to fit DETECTOR_FRAME_SIZE before detection. The
+    cascade has no batched form (detectMultiScale takes one image), and it
+    releases the GIL, so concurrent requests detect in parallel on their
+    own threads, each with its own classifier.
+    """
+
+    def __init__(self, frame_size=DETECTOR_FRAME_SIZE, min_face=DETECTOR_MIN_FACE):
+        # Only needed when the cascade detector is used
+        import cv2
+        self._cv2 = cv2
+        self._cascade_path = os.path.join(cv2.data.haarcascades, CASCADE_FILE)
+        if cv2.CascadeClassifier(self._cascade_path).empty():
+            raise ValueError(f'Could not load face cascade {self._cascade_path}')
+        self.frame_size = frame_size
+        self.min_face = min_face
+        # Cascade classifiers aren't safe to share between threads
+        self._local = threading.local()
+
+    def _classifier(self):
+        classifier = getattr(self._local, 'classifier', None)
+        if classifier is None:
+            classifier = self._local.classifier = self._cv2.CascadeClassifier(self._cascade_path)
+        return classifier
+
+    def prepare(self, image):
+        """Downscale an image to grayscale pixels, returning (pixels, scale)"""
+        width, height = self.frame_size
+        scale = min(width / image.width, height / image.height, 1.0)
+        gray = image.convert('L')
+        if scale < 1.0:
+            gray = gray.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                               Image.BILINEAR)
+        return np.asarray(gray), scale
+
+    def _locations(self, boxes, scale):
+        """Map canvas boxes to (top, right, bottom, left) in the original image"""
+        return [(int(y / scale), int((x + w) / scale), int((y + h) / scale), int(x / scale))
+                for x, y, w, h in boxes]
+
+    def detect(self, image):
+        """Face locations in an image"""
+        pixels, scale = self.prepare(image)
+        boxes = self._classifier().detectMultiScale(pixels, scaleFactor=DETECTOR_SCALE_FACTOR,
+                                                    minNeighbors=DETECTOR_MIN_NEIGHBORS,
+                                                    minSize=(self.min_face, self.min_face))
+        return self._locations(boxes, scale)
+
+def create_detector(name=FACE_DETECTOR):
+    """Create the detector selected by FACE_DETECTOR, or None if it's unavailable"""
+    if name == 'none':
+        return None
+    if name != 'cascade':
+        raise ValueError(f"Unknown FACE_DETECTOR '{name}', expected cascade or none")
+    try:
+        return CascadeFaceDetector()
+    except ImportError:
+        print("OpenCV is not installed, multiple face detection is disabled")
+        return None
@@ -0,0 +1,255 @@
+import os
+import numpy as np
+from augment import generate_variations
+from detection import DETECTOR_FRAME_SIZE, create_detector
+from features import (DECODE_SIZE, FEATURE_SIZE, base64_to_image, coarse_features, image_to_features,
+                      image_to_hash, image_to_pixels, normalize_pixels, pack_features, score_batch,
+                      unpack_features)
+from hashing import pixels_to_phash
+
+# Engine used for registration, verification and monitoring: pil (grayscale
+# region comparison, no extra dependencies) or face_recognition (dlib
+# detection and 128-d embeddings)
+FACE_ENGINE = os.getenv('FACE_ENGINE', 'pil')
+# face_recognition distance at or below which two faces are the same person
+FACE_DISTANCE_TOLERANCE = float(os.getenv('FACE_DISTANCE_TOLERANCE', 0.6))
+# Frames are decoded at a reduced resolution no smaller than this for detection
+DETECTION_DECODE_SIZE = (640, 360)
+# Smallest accepted registration image, in pixels per side
+MIN_IMAGE_SIZE = 100
+# Larger registration images are scaled down to 1000 pixels wide first
+MAX_IMAGE_SIZE = 2000
+
+class FaceEmbeddingError(ValueError):
+    """Raised when an image doesn't contain exactly one usable face
+
+    warning is the code reported to monitoring clients.
+    """
+
+    def __init__(self, message, warning, face_count=None):
+        super().__init__(message)
+        self.warning = warning
+        self.face_count = face_count
+
+def prepare_image(image):
+    """Validate a registration image, scaling down very large ones
+
+    Raises ValueError for images that can't be registered.
+    """
+    # Basic validation: check if image is of reasonable size
+    if image.width < MIN_IMAGE_SIZE or image.height < MIN_IMAGE_SIZE:
+        raise ValueError('Image is too small. Please provide a larger image.')
+
+    # Check if image is too large (to prevent DoS)
+    if image.width > MAX_IMAGE_SIZE or image.height > MAX_IMAGE_SIZE:
+        # Resize to reasonable dimensions
+        image = image.resize((1000, int(1000 * image.height / image.width)))
+        print(f"Image resized to {image.width}x{image.height}")
+
+    return image
+
+class PILEngine:
+    """Region-based comparison of normalized 64x64 grayscale images
+
+    Embeddings are the features of the registration image and its
+    variations; similarity is the region-based score. Faces are counted
+    with a lightweight detector when one is available (see detection.py);
+    without one the whole frame counts as one face.
+    """
+
+    name = 'pil'
+    embedding_shape = (FEATURE_SIZE, FEATURE_SIZE)
+    grayscale = True
+    # Similarity at or above which a face matches
+    match_threshold = 0.6
+
+    def __init__(self, detector=None):
+        self.detector = detector
+        self.detects_faces = detector is not None
+        # Frames are decoded large enough for the detector when there is one
+        self.decode_size = DETECTOR_FRAME_SIZE if detector is not None else DECODE_SIZE
+
+    def detect(self, image):
+        """Face locations as (top, right, bottom, left) tuples"""
+        if self.detector is None:
+            return [(0, image.width, image.height, 0)]
+        return self.detector.detect(image)
+
+    def embed(self, image, locations=None):
+        """Embedding of the face in a probe image
+
+        The whole frame is compared, as at registration. Raises
+        FaceEmbeddingError when locations show more than one face; a frame
+        where the detector finds none is still compared.
+        """
+        if locations is not None and len(locations) > 1:
+            raise FaceEmbeddingError('Multiple faces detected', 'multiple_faces', len(locations))
+        return image_to_features(image)
+
+    def similarity(self, probe, embeddings):
+        """Similarity of a probe to every row of an embedding matrix, higher is closer"""
+        return score_batch(probe, embeddings)
+
+    def distance(self, probe, embeddings):
+        """Distance of a probe to every row of an embedding matrix, lower is closer"""
+        return 1.0 - self.similarity(probe, embeddings)
+
+    def coarse(self, embeddings):
+        """Cheap reduced embeddings used to rank candidates"""
+        return coarse_features(embeddings)
+
+    def enroll(self, image):
+        """Build what is stored for a registration image
+
+        Returns (document fields, embeddings, variation ids, perceptual
+        hash). Raises ValueError for images that can't be registered.
+        """
+        image = prepare_image(image)
+        # Create variations of the image for more robust matching,
+        # reduced to the 64x64 pixels that are actually compared
+        # (variation 0 is the original image)
+        pixels = generate_variations(image)
+        variation_ids = list(range(len(pixels)))
+        fields = {
+            'faceHash': image_to_hash(image),
+            'features': pack_features(pixels, variation_ids)
+        }
+        return fields, normalize_pixels(pixels), variation_ids, pixels_to_phash(pixels[0])
+
+    def document_embeddings(self, face_data):
+        """Load the embeddings of a face_data document
+
+        Packed features are used when present; older documents have their
+        stored base64 images decoded instead. Returns (embeddings,
+        variation ids, perceptual hash of the original image or None).
+        """
+        pixels, variation_ids = unpack_features(face_data.get('features'))
+        if pixels is not None:
+            phash = pixels_to_phash(pixels[variation_ids.index(0)]) if 0 in variation_ids else None
+            return normalize_pixels(pixels), variation_ids, phash
+
+        features = []
+        variation_ids = []
+        phash = None
+
+        # The original image is reported as variation 0
+        if face_data.get('imageData'):
+            try:
+                pixels = image_to_pixels(base64_to_image(face_data['imageData'], DECODE_SIZE))
+                features.append(normalize_pixels(pixels))
+                variation_ids.append(0)
+                phash = pixels_to_phash(pixels)
+            except Exception as e:
+                print(f"Error decoding original image for user {face_data.get('userId')}: {str(e)}")
+
+        for variation in face_data.get('variations') or []:
+            try:
+                features.append(normalize_pixels(image_to_pixels(base64_to_image(variation['data'], DECODE_SIZE))))
+                variation_ids.append(variation['index'])
+            except Exception as e:
+                print(f"Error decoding variation {variation.get('index')} for user {face_data.get('userId')}: {str(e)}")
+
+        return features, variation_ids, phash
+
+class FaceRecognitionEngine:
+    """dlib face detection and 128-d face embeddings via face_recognition
+
+    Similarity is 1 - Euclidean distance, so a distance tolerance of 0.6
+    is a similarity threshold of 0.4. Faces are stored as faceEncoding,
+    the format used by app.py.
+    """
+
+    name = 'face_recognition'
+    embedding_shape = (128,)
+    decode_size = DETECTION_DECODE_SIZE
+    grayscale = False
+    detects_faces = True
+    match_threshold = 1.0 - FACE_DISTANCE_TOLERANCE
+
+    def __init__(self):
+        # Only needed when this engine is selected
+        import face_recognition
+        self._face_recognition = face_recognition
+
+    def detect(self, image):
+        """Face locations as (top, right, bottom, left) tuples"""
+        return self._face_recognition.face_locations(np.asarray(image.convert('RGB')))
+
+    def embed(self, image, locations=None):
+        """Embedding of the single face in an image
+
+        Raises FaceEmbeddingError when there is no face or more than one.
+        """
+        pixels = np.asarray(image.convert('RGB'))
+        if locations is None:
+            locations = self._face_recognition.face_locations(pixels)
+
+        if not locations:
+            raise FaceEmbeddingError('No face detected in the image', 'face_missing', 0)
+        if len(locations) > 1:
+            raise FaceEmbeddingError('Multiple faces detected. Please provide an image with only one face',
+                                     'multiple_faces', len(locations))
+
+        encodings = self._face_recognition.face_encodings(pixels, locations)
+        if not encodings:
+            raise FaceEmbeddingError('Failed to encode face', 'encoding_failed', 1)
+        return encodings[0]
+
+    def distance(self, probe, embeddings):
+        """Euclidean distance of a probe to every row of an (N, 128) matrix"""
+        return np.linalg.norm(np.asarray(embeddings) - probe, axis=1)
+
+    def similarity(self, probe, embeddings):
+        """Similarity of a probe to every row of an embedding matrix, higher is closer"""
+        return 1.0 - self.distance(probe, embeddings)
+
+    def coarse(self, embeddings):
+        """Embeddings are already small enough to rank directly"""
+        return np.asarray(embeddings)
+
+    def enroll(self, image):
+        """Build what is stored for a registration image
+
+        Returns (document fields, embeddings, variation ids, perceptual
+        hash). Raises ValueError for images that can't be registered.
+        """
+        image = prepare_image(image)
+        encoding = self.embed(image)
+        fields = {
+            'faceHash': image_to_hash(image),
+            'faceEncoding': encoding.tolist()
+        }
+        # No pixels are stored to derive a perceptual hash from on reload
+        return fields, encoding[np.newaxis], [0], None
+
+    def document_embeddings(self, face_data):
+        """Load the embedding of a face_data document
+
+        Returns (embeddings, variation ids, perceptual hash); documents
+        registered with another engine have no embedding.
+        """
+        encoding = face_data.get('faceEncoding')
+        if encoding is None:
+            return [], [], None
+        return np.asarray(encoding, dtype=np.float64)[np.newaxis], [0], None
+
+ENGINES = {
+    PILEngine.name: PILEngine,
+    FaceRecognitionEngine.name: FaceRecognitionEngine
+}
+
+# Engine shared by the process, created on first use
+_engine = None
+
+def get_engine():
+    """Return the engine selected by FACE_ENGINE"""
+    global _engine
+    if _engine is None:
+        if FACE_ENGINE not in ENGINES:
+            raise ValueError(f"Unknown FACE_ENGINE '{FACE_ENGINE}', expected one of: {', '.join(ENGINES)}")
+        if FACE_ENGINE == PILEngine.name:
+            _engine = PILEngine(create_detector())
+        else:
+            _engine = ENGINES[FACE_ENGINE]()
+        print(f"Using face engine: {_engine.name}")
+    return _engine
@@ -0,0 +1,31 @@
+from engines import get_engine
+from features import base64_to_image, decode_image
+
+# Entry module for enrollment worker processes. It only imports what
+# decoding and embedding need, so starting a worker doesn't load the server.
+
+def prepare_record(record):
+    """Decode and embed one enrollment record, in a worker process
+
+    A record has userId, name and either imageBytes (raw file contents) or
+    image (base64 string). Failures are returned rather than raised so one
+    bad image doesn't stop a bulk run.
+    """
+    try:
+        if record.get('imageBytes') is not None:
+            image = decode_image(record['imageBytes'])
+        else:
+            image = base64_to_image(record['image'])
+        fields, embeddings, variation_ids, phash = get_engine().enroll(image)
+    except Exception as e:
+        return {'userId': record.get('userId'), 'success': False, 'message': f'Invalid image data: {str(e)}'}
+
+    return {
+        'userId': record['userId'],
+        'name': record['name'],
+        'success': True,
+        'fields': fields,
+        'embeddings': embeddings,
+        'variationIds': variation_ids,
+        'phash': phash
+    }
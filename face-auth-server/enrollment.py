@@ -0,0 +1,163 @@
+import base64
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from enroll_worker import prepare_record
+
+# Number of faces written per bulk_write call
+BULK_WRITE_SIZE = int(os.getenv('BULK_WRITE_SIZE', 500))
+# Worker processes used for decoding and embedding (0 means one per core)
+ENROLL_WORKERS = int(os.getenv('ENROLL_WORKERS', 0)) or None
+# Keep the original registration images in a separate collection
+STORE_RAW_IMAGES = os.getenv('STORE_RAW_IMAGES', 'true').lower() == 'true'
+RAW_IMAGE_COLLECTION = os.getenv('RAW_IMAGE_COLLECTION', 'face_images')
+
+# Worker pool shared by every enrollment in this process, started on first use
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+def face_upsert(user_id, name, fields):
+    """Build the upsert that stores one enrolled face, given the engine's document fields"""
+    now = datetime.now()
+    return UpdateOne(
+        {'userId': user_id},
+        {
+            '$set': dict(fields, name=name, updatedAt=now),
+            '$setOnInsert': {
+                'isVerified': False,
+                'registeredAt': now,
+                'lastVerifiedAt': None,
+                'verificationCount': 0
+            },
+            # Images stored by older versions are no longer read
+            '$unset': {
+                'imageData': '',
+                'variations': ''
+            }
+        },
+        upsert=True
+    )
+
+def raw_image_upsert(record):
+    """Build the upsert that keeps a record's original image, as /register stores it"""
+    image = record.get('image')
+    if image is None:
+        image = base64.b64encode(record['imageBytes']).decode('ascii')
+    return UpdateOne(
+        {'userId': record['userId']},
+        {'$set': {'imageData': image, 'updatedAt': datetime.now()}},
+        upsert=True
+    )
+
+def enrollment_pool(workers=ENROLL_WORKERS):
+    """The process's enrollment worker pool, started on first use
+
+    The pool is spawned rather than forked, since the server uses it from a
+    request thread of a process that already runs database and background
+    threads, and it's kept for the life of the process so each bulk run
+    doesn't start new interpreters. Its size is set by the first call.
+    """
+    global _pool, _pool_size
+    with _pool_lock:
+        if _pool is None:
+            _pool_size = workers or os.cpu_count() or 1
+            _pool = ProcessPoolExecutor(max_workers=_pool_size, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+def _discard_pool(pool):
+    """Drop a broken pool so the next run starts a new one"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+def _prepare_all(records, workers):
+    """Run prepare_record in the worker pool, yielding (record, result) in input order
+
+    At most a few records per worker are in flight, so a large import
+    doesn't hold every image in memory at once.
+    """
+    pool = enrollment_pool(workers)
+    max_in_flight = _pool_size * 4
+    in_flight = deque()
+    try:
+        for record in records:
+            in_flight.append((record, pool.submit(prepare_record, record)))
+            if len(in_flight) >= max_in_flight:
+                record, future = in_flight.popleft()
+                yield record, future.result()
+        while in_flight:
+            record, future = in_flight.popleft()
+            yield record, future.result()
+    except BrokenProcessPool:
+        # A worker died (killed or out of memory)
+        print("Enrollment worker died, restarting the pool on the next run")
+        _discard_pool(pool)
+        raise
+    finally:
+        # A run stopped early (client gone) leaves nothing queued behind
+        for _, future in in_flight:
+            future.cancel()
+
+def _write(collection, prepared, raw_images=None):
+    """Write prepared faces with one unordered bulk_write, yielding per-record results
+
+    prepared holds (record, result) pairs. With raw_images, the original
+    images of the faces written are stored there too.
+    """
+    if not prepared:
+        return
+
+    ops = [face_upsert(r['userId'], r['name'], r['fields']) for _, r in prepared]
+    errors = {}
+    try:
+        collection.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        errors = {err['index']: err.get('errmsg', 'Write failed') for err in e.details.get('writeErrors', [])}
+
+    # Keep the original images out of the hot collection
+    if raw_images is not None:
+        raw_ops = [raw_image_upsert(record) for i, (record, _) in enumerate(prepared) if i not in errors]
+        if raw_ops:
+            raw_images.bulk_write(raw_ops, ordered=False)
+
+    prepared = [result for _, result in prepared]
+
+    # Document ids are needed to keep in-memory indexes up to date
+    written = [r['userId'] for i, r in enumerate(prepared) if i not in errors]
+    doc_ids = {doc['userId']: doc['_id']
+               for doc in collection.find({'userId': {'$in': written}}, {'_id': 1, 'userId': 1})}
+
+    for i, result in enumerate(prepared):
+        if i in errors:
+            yield {'userId': result['userId'], 'success': False, 'message': errors[i]}
+        else:
+            yield dict(result, _id=doc_ids.get(result['userId']), message='Face enrolled successfully')
+
+def enroll(collection, records, workers=ENROLL_WORKERS, batch_size=BULK_WRITE_SIZE, raw_images=None):
+    """Enroll many faces, yielding one result per record as the run progresses
+
+    Images are decoded and embedded in a process pool and written with
+    unordered bulk_write upserts, along with the original images when a
+    raw_images collection is given. Successful results carry the
+    embeddings, variation ids, perceptual hash and document _id; failed
+    ones carry a message.
+    """
+    pending = []
+    for record, result in _prepare_all(records, workers):
+        if not result['success']:
+            yield result
+            continue
+        pending.append((record, result))
+        if len(pending) >= batch_size:
+            yield from _write(collection, pending, raw_images)
+            pending = []
+    yield from _write(collection, pending, raw_images)
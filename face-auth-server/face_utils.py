@@ -1,17 +1,17 @@
 import base64
-import io
 import numpy as np
 import face_recognition
-from PIL import Image
+from engines import DETECTION_DECODE_SIZE
+from features import decode_image
 
-def base64_to_image(base64_string):
-    """Convert base64 string to PIL Image"""
+def base64_to_image(base64_string, size=DETECTION_DECODE_SIZE):
+    """Convert base64 string to an RGB numpy array"""
     if ',' in base64_string:
         base64_string = base64_string.split(',')[1]
     
     image_data = base64.b64decode(base64_string)
-    image = Image.open(io.BytesIO(image_data))
-    return np.array(image)
+    image = decode_image(image_data, size)
+    return np.array(image.convert('RGB'))
 
 def detect_faces(image):
     """Detect faces in an image"""
@@ -52,19 +52,22 @@ def face_distance(known_encoding, unknown_encoding):
     return distances[0] if len(distances) > 0 else 1.0
 
 def find_best_match(face_encoding, registered_faces, threshold=0.6):
-    """Find the best match for a face encoding among registered faces"""
-    best_match = None
-    best_match_distance = 1.0
+    """Find the best match for a face encoding among registered faces
+
+    Every stored encoding is compared in one face_distance call over an
+    (N, 128) matrix. For repeated matching, keep the matrix resident with
+    gallery.GalleryIndex and FACE_ENGINE=face_recognition instead.
+    """
+    registered_faces = list(registered_faces)
+    if not registered_faces:
+        return None, 1.0
     
-    for face_data in registered_faces:
-        stored_encoding = np.array(face_data['faceEncoding'])
-        distance = face_distance(stored_encoding, face_encoding)
-        
-        if distance < best_match_distance:
-            best_match_distance = distance
-            best_match = face_data
+    known_encodings = np.array([face_data['faceEncoding'] for face_data in registered_faces])
+    distances = face_recognition.face_distance(known_encodings, face_encoding)
+    best = int(np.argmin(distances))
+    best_match_distance = min(float(distances[best]), 1.0)
     
-    if best_match and best_match_distance < threshold:
-        return best_match, best_match_distance
+    if best_match_distance < threshold:
+        return registered_faces[best], best_match_distance
     else:
-        return None, best_match_distance 
\ No newline at end of file
+        return None, best_match_distance
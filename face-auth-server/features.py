@@ -0,0 +1,185 @@
+import base64
+import hashlib
+import io
+import numpy as np
+from PIL import Image, ImageFilter
+from hashing import phash_bits, phash_pixels, pixels_to_phash
+
+# Size of the square grayscale arrays every comparison works on
+FEATURE_SIZE = 64
+# Decode size for frames that are only compared: twice the comparison size,
+# which keeps scores within ~1% of a full resolution decode
+DECODE_SIZE = (2 * FEATURE_SIZE, 2 * FEATURE_SIZE)
+# Grid used for region-based comparison (4x4 regions of 16x16 pixels)
+REGION_GRID = 4
+# Number of best matching regions averaged into the region score
+BEST_REGIONS = 10
+# Number of reference arrays scored at once, bounds temporary memory
+SCORE_CHUNK_SIZE = 1024
+# Side of the pooled features used for cheap candidate ranking
+COARSE_SIZE = 16
+# Version of the packed feature format stored in face_data documents
+FEATURE_FORMAT_VERSION = 1
+
+def base64_to_bytes(base64_string):
+    """Convert a base64 string or data URL to the encoded image bytes"""
+    if ',' in base64_string:
+        base64_string = base64_string.split(',')[1]
+
+    return base64.b64decode(base64_string)
+
+def base64_to_image(base64_string, size=None, grayscale=False):
+    """Convert base64 string to PIL Image"""
+    return decode_image(base64_to_bytes(base64_string), size, grayscale)
+
+def decode_image(image_data, size=None, grayscale=False):
+    """Convert encoded image bytes (JPEG, PNG, ...) to PIL Image
+
+    With a size, JPEG frames are decoded straight to a reduced resolution
+    (scaled DCT, 1/2 to 1/8) that is still at least that size. With
+    grayscale, only the luma channel is decoded. Other formats are decoded
+    at full resolution and converted.
+    """
+    image = Image.open(io.BytesIO(image_data))
+    if size is not None or grayscale:
+        image.draft('L' if grayscale else 'RGB', size or image.size)
+    if grayscale and image.mode != 'L':
+        image = image.convert('L')
+    return image
+
+def image_to_hash(image):
+    """Convert image to a hash for simple comparison"""
+    return pixels_to_hash(image_to_pixels(image))
+
+def pixels_to_hash(pixels):
+    """Face hash string of 64x64 comparison pixels, as stored in faceHash
+
+    An MD5 of the 32x32 perceptual hash input followed by the leading hex
+    digits of the perceptual hash. Use pixels_to_phash for the full packed
+    hash that can be compared by Hamming distance.
+    """
+    small = phash_pixels(pixels)
+    # Leading zero bits are dropped, as in the original hex string form
+    hex_hash = hex(int.from_bytes(np.packbits(phash_bits(small)).tobytes(), 'big'))[2:]
+    md5_hash = hashlib.md5(small.flatten().tobytes()).hexdigest()
+    # Combine both hashes for better discrimination
+    return md5_hash + hex_hash[:16]  # Limit hex_hash to 16 chars
+
+def image_to_phash(image):
+    """Packed 1024-bit perceptual hash of an image"""
+    return pixels_to_phash(image_to_pixels(image))
+
+def image_to_pixels(image):
+    """Resize, grayscale and blur an image to the 64x64 uint8 array that is compared"""
+    # Resize to the comparison size first, then grayscale and blur
+    image = image.resize((FEATURE_SIZE, FEATURE_SIZE))
+    image = image.convert('L')
+    image = image.filter(ImageFilter.GaussianBlur(radius=1.0))
+    return np.array(image)
+
+def normalize_pixels(pixels):
+    """Normalize a 64x64 pixel array, or a stack of them, to account for lighting changes"""
+    arr = np.asarray(pixels).astype(float)
+    mean = arr.mean(axis=(-2, -1), keepdims=True)
+    std = arr.std(axis=(-2, -1), keepdims=True)
+    return (arr - mean) / (std + 1e-5)
+
+def image_to_features(image):
+    """Convert a PIL image to the normalized 64x64 array used for comparison"""
+    return normalize_pixels(image_to_pixels(image))
+
+def coarse_features(features, size=COARSE_SIZE):
+    """Average-pool 64x64 feature arrays, or a stack of them, down to size x size"""
+    features = np.asarray(features)
+    factor = FEATURE_SIZE // size
+    pooled = features.reshape(features.shape[:-2] + (size, factor, size, factor))
+    return pooled.mean(axis=(-3, -1))
+
+def pack_features(pixels, variation_ids):
+    """Pack a stack of 64x64 uint8 pixel arrays for storage in a face_data document
+
+    The pixels are stored before normalization, which is exact to redo on
+    load and keeps each variation at 4 KB.
+    """
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    return {
+        'version': FEATURE_FORMAT_VERSION,
+        'dtype': 'uint8',
+        'shape': list(pixels.shape),
+        'variationIds': [int(i) for i in variation_ids],
+        'data': pixels.tobytes()
+    }
+
+def unpack_features(packed):
+    """Unpack stored pixel arrays, returning (pixels, variation ids)
+
+    Returns (None, None) for a format version this server doesn't know.
+    """
+    if not packed or packed.get('version') != FEATURE_FORMAT_VERSION:
+        return None, None
+    pixels = np.frombuffer(packed['data'], dtype=packed['dtype']).reshape(packed['shape'])
+    return pixels, packed['variationIds']
+
+def compare_features(arr1, arr2):
+    """Compare two normalized feature arrays and return a similarity score"""
+    scores, mad, best_regions_similarity = _score_chunk(arr1, arr2[np.newaxis])
+    similarity = scores[0]
+
+    # Print debug info occasionally
+    if np.random.random() < 0.05:  # 5% of the time
+        print(f"Image comparison - MAD: {mad[0]:.4f}, Overall: {np.exp(-mad[0]):.4f}, Best Regions: {best_regions_similarity[0]:.4f}, Final: {similarity:.4f}")
+
+    return similarity
+
+def _score_chunk(probe, references):
+    """Score a probe against a stack of references, returning the score parts"""
+    # Calculate mean absolute difference (MAD) for every reference
+    diff = np.abs(references - probe)
+    mad = diff.mean(axis=(1, 2))
+
+    # Split each difference map into a 4x4 grid of regions and take the MAD
+    # of each region. Comparing regions separately makes the score more
+    # robust to changes in expression and position.
+    n, rows, cols = diff.shape
+    region_rows, region_cols = rows // REGION_GRID, cols // REGION_GRID
+    region_mad = diff.reshape(n, REGION_GRID, region_rows, REGION_GRID, region_cols).mean(axis=(2, 4))
+    region_mad = region_mad.reshape(n, REGION_GRID * REGION_GRID)
+
+    # Average the best 10 regions (out of 16), i.e. the 10 smallest MADs
+    # This allows for some facial regions to change while still maintaining a match
+    best_regions = np.partition(region_mad, BEST_REGIONS - 1, axis=1)[:, :BEST_REGIONS]
+    best_regions_similarity = np.exp(-best_regions).mean(axis=1)
+
+    # Blend with the overall similarity for a balanced approach
+    scores = 0.7 * best_regions_similarity + 0.3 * np.exp(-mad)
+    return scores, mad, best_regions_similarity
+
+def score_batch(probe, references):
+    """Score one probe array against an (N, 64, 64) stack of reference arrays
+
+    Gives the same scores as compare_features applied to each reference in
+    turn. References are processed in chunks to bound temporary memory.
+    """
+    references = np.asarray(references)
+    scores = np.empty(len(references))
+
+    for start in range(0, len(references), SCORE_CHUNK_SIZE):
+        chunk = references[start:start + SCORE_CHUNK_SIZE]
+        scores[start:start + len(chunk)] = _score_chunk(probe, chunk)[0]
+
+    return scores
+
+def score_pairs(probes, references):
+    """Score an (N, 64, 64) stack of probes against references pairwise
+
+    Gives the same scores as compare_features applied to each pair.
+    """
+    probes = np.asarray(probes)
+    references = np.asarray(references)
+    scores = np.empty(len(probes))
+
+    for start in range(0, len(probes), SCORE_CHUNK_SIZE):
+        end = start + SCORE_CHUNK_SIZE
+        scores[start:start + len(probes[start:end])] = _score_chunk(probes[start:end], references[start:end])[0]
+
+    return scores
@@ -0,0 +1,244 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+import numpy as np
+from PIL import Image
+from features import FEATURE_SIZE, decode_image, image_to_features, image_to_pixels, pixels_to_hash, score_pairs
+from hashing import pixels_to_phash
+
+# Worker processes for frame decoding, hashing and comparison (0 runs them
+# on the request thread)
+FRAME_POOL_WORKERS = int(os.getenv('FRAME_POOL_WORKERS', 0))
+# Frames in the pool at once; each holds one shared memory slot, and further
+# requests wait for a free slot
+FRAME_POOL_QUEUE_DEPTH = int(os.getenv('FRAME_POOL_QUEUE_DEPTH', 4 * max(FRAME_POOL_WORKERS, 1)))
+# Size of each slot, in bytes; larger frames are processed on the request thread
+FRAME_POOL_SLOT_BYTES = int(os.getenv('FRAME_POOL_SLOT_BYTES', 4 * 1024 * 1024))
+
+FEATURE_SHAPE = (FEATURE_SIZE, FEATURE_SIZE)
+FEATURE_BYTES = FEATURE_SIZE * FEATURE_SIZE * 4
+# Decoded pixel arrays start on a 64-byte boundary after the encoded input
+SLOT_ALIGN = 64
+
+# Shared memory slots attached by each worker process, by name
+_segments = {}
+
+def _align(offset):
+    return (offset + SLOT_ALIGN - 1) // SLOT_ALIGN * SLOT_ALIGN
+
+def _attach(names):
+    """Worker initializer: attach every slot once"""
+    for name in names:
+        _segments[name] = shared_memory.SharedMemory(name=name)
+
+def _ready():
+    return os.getpid()
+
+def _view(name, offset, shape, dtype):
+    return np.ndarray(shape, dtype=dtype, buffer=_segments[name].buf, offset=offset)
+
+def load_image(image_data, size=None, grayscale=False):
+    """decode_image, forcing the decode and normalizing the mode to one a pixel array keeps"""
+    image = decode_image(image_data, size, grayscale)
+    if image.mode not in ('L', 'RGB', 'RGBA'):
+        image = image.convert('RGB')
+    image.load()
+    return image
+
+def _decode_task(name, length, size, grayscale):
+    """Decode the encoded image at the start of a slot, writing its pixels after it"""
+    pixels = np.asarray(load_image(bytes(_segments[name].buf[:length]), size, grayscale))
+    offset = _align(length)
+    if offset + pixels.nbytes > _segments[name].size:
+        return None
+    _view(name, offset, pixels.shape, pixels.dtype)[...] = pixels
+    return offset, pixels.shape, pixels.dtype.str
+
+def _hash_task(name, shape, dtype):
+    """faceHash and packed perceptual hash of the pixels at the start of a slot"""
+    pixels = image_to_pixels(Image.fromarray(_view(name, 0, shape, dtype)))
+    return pixels_to_hash(pixels), pixels_to_phash(pixels)
+
+def _features_task(name, shape, dtype):
+    """Features of the pixels at the start of a slot, written after them"""
+    features = image_to_features(Image.fromarray(_view(name, 0, shape, dtype))).astype(np.float32)
+    offset = _align(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    _view(name, offset, FEATURE_SHAPE, np.float32)[...] = features
+    return offset
+
+def _hash_inline(image):
+    pixels = image_to_pixels(image)
+    return pixels_to_hash(pixels), pixels_to_phash(pixels)
+
+class FramePool:
+    """Process pool for the CPU-bound stages of frame handling
+
+    Decoding, hashing and feature comparison are CPU-bound, and the Python
+    code between the PIL and NumPy calls holds the GIL, so the request
+    threads of one server process don't scale across cores. The pool runs
+    these stages in worker processes instead. Encoded frames, decoded pixels
+    and features are handed over through a fixed set of shared memory
+    slots, one per queued frame; only offsets, shapes and scores are
+    pickled.
+
+    With no workers, every stage runs on the calling thread. Per-stage
+    timings are kept either way. Frames are always scored on the calling
+    thread, with score_pair, so scoring can be batched across requests
+    whether or not features come from the pool.
+    """
+
+    def __init__(self, workers=FRAME_POOL_WORKERS, queue_depth=FRAME_POOL_QUEUE_DEPTH,
+                 slot_bytes=FRAME_POOL_SLOT_BYTES, score_pair=None):
+        # score_pair(features, previous) scores each frame against the previous one
+        self.workers = workers
+        self.queue_depth = queue_depth if workers else 0
+        self.slot_bytes = slot_bytes
+        self.score_pair = score_pair or (lambda a, b: float(score_pairs(a[None], b[None])[0]))
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._waiting = 0
+        self._in_flight = 0
+        self._inline = 0
+        self._restarts = 0
+        self._slots = []
+        self._free = queue.Queue()
+        self._executor = None
+        if workers:
+            self._slots = [shared_memory.SharedMemory(create=True, size=slot_bytes) for _ in range(self.queue_depth)]
+            for slot in self._slots:
+                self._free.put(slot)
+            self._start()
+            atexit.register(self.close)
+
+    def _start(self):
+        """Start the worker processes and wait until each one has attached the slots"""
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_attach,
+                                             initargs=([slot.name for slot in self._slots],))
+        for future in [self._executor.submit(_ready) for _ in range(self.workers)]:
+            future.result()
+
+    def close(self):
+        """Stop the workers and release the shared memory"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for slot in self._slots:
+            slot.close()
+            slot.unlink()
+        self._slots = []
+
+    @contextmanager
+    def _slot(self):
+        with self._lock:
+            self._waiting += 1
+        slot = self._free.get()
+        with self._lock:
+            self._waiting -= 1
+            self._in_flight += 1
+        try:
+            yield slot
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._free.put(slot)
+
+    def _run(self, task, *args):
+        executor = self._executor
+        try:
+            return executor.submit(task, *args).result()
+        except BrokenProcessPool:
+            # A worker died (killed or out of memory); the first request to
+            # notice starts a new pool
+            with self._lock:
+                if self._executor is executor:
+                    print("Frame pool worker died, restarting the pool")
+                    self._restarts += 1
+                    self._start()
+            return self._executor.submit(task, *args).result()
+
+    @contextmanager
+    def _timed(self, stage):
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            timing = self._timings.setdefault(stage, {'count': 0, 'totalSeconds': 0.0, 'maxSeconds': 0.0})
+            timing['count'] += 1
+            timing['totalSeconds'] += elapsed
+            timing['maxSeconds'] = max(timing['maxSeconds'], elapsed)
+
+    def _use_pool(self, nbytes):
+        if self.workers and nbytes + FEATURE_BYTES + SLOT_ALIGN <= self.slot_bytes:
+            return True
+        if self.workers:
+            with self._lock:
+                self._inline += 1
+        return False
+
+    def decode(self, image_data, size=None, grayscale=False):
+        """Decode an encoded image to a loaded PIL image, like decode_image"""
+        with self._timed('decode'):
+            # Decoded frames are at most a few times the encoded size; the
+            # worker reports frames that don't fit and they're decoded here
+            if self._use_pool(len(image_data)):
+                with self._slot() as slot:
+                    slot.buf[:len(image_data)] = image_data
+                    result = self._run(_decode_task, slot.name, len(image_data), size, grayscale)
+                    if result is not None:
+                        offset, shape, dtype = result
+                        return Image.fromarray(np.ndarray(shape, dtype=dtype, buffer=slot.buf, offset=offset).copy())
+                with self._lock:
+                    self._inline += 1
+            return load_image(image_data, size, grayscale)
+
+    def hashes(self, image):
+        """faceHash and packed perceptual hash of an image, from the same 64x64 pixels"""
+        with self._timed('hash'):
+            pixels = np.asarray(image)
+            if not self._use_pool(pixels.nbytes):
+                return _hash_inline(image)
+            with self._slot() as slot:
+                np.ndarray(pixels.shape, dtype=pixels.dtype, buffer=slot.buf)[...] = pixels
+                return self._run(_hash_task, slot.name, pixels.shape, pixels.dtype.str)
+
+    def compare(self, image, previous):
+        """Normalized features of a frame and their similarity to the previous frame's features
+
+        The similarity is None without previous features.
+        """
+        with self._timed('compare'):
+            pixels = np.asarray(image)
+            if not self._use_pool(pixels.nbytes):
+                features = image_to_features(image).astype(np.float32)
+            else:
+                with self._slot() as slot:
+                    np.ndarray(pixels.shape, dtype=pixels.dtype, buffer=slot.buf)[...] = pixels
+                    offset = self._run(_features_task, slot.name, pixels.shape, pixels.dtype.str)
+                    features = np.ndarray(FEATURE_SHAPE, dtype=np.float32, buffer=slot.buf, offset=offset).copy()
+            return features, self.score_pair(features, previous) if previous is not None else None
+
+    def stats(self):
+        """Report the pool size, queue depth and per-stage timings"""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queueDepth': self.queue_depth,
+                'inFlight': self._in_flight,
+                'waiting': self._waiting,
+                'inline': self._inline,
+                'restarts': self._restarts,
+                'stages': {
+                    stage: {
+                        'count': timing['count'],
+                        'avgMs': timing['totalSeconds'] / timing['count'] * 1000,
+                        'maxMs': timing['maxSeconds'] * 1000
+                    }
+                    for stage, timing in self._timings.items()
+                }
+            }
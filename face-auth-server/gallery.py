@@ -0,0 +1,368 @@
+import os
+import random
+import threading
+import time
+import numpy as np
+from engines import get_engine
+from hashing import PHASH_WORDS, hamming_distances
+
+# Seconds before a user found unregistered is looked up in the database again
+GALLERY_MISS_TTL = float(os.getenv('GALLERY_MISS_TTL', 30))
+# Fields needed to build a gallery entry from a face_data document;
+# imageData and variations are only present on documents written before
+# packed features were stored, faceEncoding on face_recognition documents
+GALLERY_PROJECTION = {'userId': 1, 'name': 1, 'faceHash': 1, 'features': 1, 'imageData': 1, 'variations': 1,
+                      'faceEncoding': 1}
+# Faces given the full comparison in open-set matching (0 compares every face)
+CASCADE_TOP_K = int(os.getenv('CASCADE_TOP_K', 0))
+# First stage of the cascade: lowres (coarse embedding distance) or
+# hash (perceptual hash distance)
+CASCADE_PREFILTER = os.getenv('CASCADE_PREFILTER', 'lowres')
+# Fraction of cascaded matches that are also run exhaustively to measure recall
+CASCADE_AUDIT_RATE = float(os.getenv('CASCADE_AUDIT_RATE', 0.01))
+
+def hash_similarity(hash1, hash2):
+    """Fraction of matching characters between two face hashes"""
+    matching_chars = sum(c1 == c2 for c1, c2 in zip(hash1, hash2))
+    return matching_chars / len(hash2)
+
+class GalleryIndex:
+    """Resident index of precomputed embeddings for every registered face
+
+    Embeddings of all registered faces are kept stacked in one contiguous
+    matrix, (M, 64, 64) features for the pil engine or (M, 128) encodings
+    for face_recognition, so a 1:N match is a single vectorized pass. Packed
+    perceptual hashes are stacked the same way, (M, 16) uint64, so a probe
+    is screened against every face with one XOR and popcount. Both are
+    rebuilt lazily on the first lookup after a write.
+
+    With a top K, open-set matching is a two-stage cascade: a cheap first
+    stage ranks every face and only the K best get the full comparison. A
+    sample of cascaded matches is checked against the exhaustive
+    comparison and counted in cascade_stats().
+    """
+
+    def __init__(self, engine=None, top_k=CASCADE_TOP_K, prefilter=CASCADE_PREFILTER,
+                 audit_rate=CASCADE_AUDIT_RATE):
+        self.engine = engine or get_engine()
+        self.top_k = top_k
+        self.prefilter = prefilter
+        self.audit_rate = audit_rate
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._hashes = {}
+        self._missing = {}
+        self._matrix = self._empty_matrix()
+        self._coarse = self.engine.coarse(self._matrix).astype(np.float32)
+        self._owners = np.empty(0, dtype=np.int64)
+        self._variation_ids = np.empty(0, dtype=np.int64)
+        self._indexed = []
+        self._positions = {}
+        self._hash_only = []
+        self._phash_codes = np.empty((0, PHASH_WORDS), dtype=np.uint64)
+        self._phash_entries = []
+        self._dirty = False
+        self._cascade_matches = 0
+        self._audited = 0
+        self._audit_hits = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        return user_id in self._entries
+
+    def load(self, collection):
+        """Populate the index from every document in the face collection
+
+        Users no longer in the collection are dropped, so this also serves
+        as a full resync.
+        """
+        loaded = set()
+        for face_data in collection.find({}, GALLERY_PROJECTION):
+            self.add_document(face_data)
+            loaded.add(face_data['userId'])
+        with self._lock:
+            for user_id in set(self._entries) - loaded:
+                self._drop(user_id)
+                self._dirty = True
+        print(f"Gallery index loaded {len(loaded)} registered faces")
+        return len(loaded)
+
+    def _empty_matrix(self):
+        return np.empty((0,) + self.engine.embedding_shape, dtype=np.float32)
+
+    def add_document(self, face_data):
+        """Index a face_data document, loading its embeddings with the engine"""
+        features, variation_ids, phash = self.engine.document_embeddings(face_data)
+        self.upsert(face_data['_id'], face_data['userId'], face_data.get('name'),
+                    face_data.get('faceHash'), features, variation_ids, phash)
+
+    def upsert(self, doc_id, user_id, name, face_hash, features, variation_ids, phash=None):
+        """Add or replace the entry for a user
+
+        phash is the packed perceptual hash of the original image, if known.
+        """
+        features = np.asarray(features, dtype=np.float32).reshape((-1,) + self.engine.embedding_shape)
+
+        with self._lock:
+            self._drop(user_id)
+            self._entries[user_id] = {
+                '_id': doc_id,
+                'userId': user_id,
+                'name': name,
+                'faceHash': face_hash,
+                'features': features,
+                'variationIds': np.asarray(variation_ids, dtype=np.int64),
+                'phash': phash
+            }
+            if face_hash:
+                self._hashes[face_hash] = user_id
+            self._missing.pop(user_id, None)
+            self._dirty = True
+
+    def remove(self, user_id):
+        """Remove a user from the index"""
+        with self._lock:
+            removed = self._drop(user_id)
+            self._dirty = self._dirty or removed
+        return removed
+
+    def remove_document(self, doc_id):
+        """Remove the entry stored from a face_data document, by document id"""
+        with self._lock:
+            user_id = next((entry['userId'] for entry in self._entries.values() if entry['_id'] == doc_id), None)
+            removed = user_id is not None and self._drop(user_id)
+            self._dirty = self._dirty or removed
+        return removed
+
+    def get(self, user_id):
+        """Return the indexed entry for a user, if any"""
+        return self._entries.get(user_id)
+
+    def get_or_load(self, user_id, collection):
+        """Return a user's entry, loading it from the database if it isn't indexed
+
+        Picks up faces registered by another process. Users found missing
+        are not looked up again for GALLERY_MISS_TTL seconds, so repeated
+        calls for an unregistered user don't each hit the database.
+        """
+        entry, lookup = self.cached(user_id)
+        if not lookup:
+            return entry
+        return self.add_lookup(user_id, collection.find_one({'userId': user_id}, GALLERY_PROJECTION))
+
+    def cached(self, user_id):
+        """Return (entry, whether the database has to be checked) for a user"""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            return entry, False
+
+        missing_since = self._missing.get(user_id)
+        if missing_since is not None and time.monotonic() - missing_since < GALLERY_MISS_TTL:
+            return None, False
+        return None, True
+
+    def add_lookup(self, user_id, face_data):
+        """Index the result of looking a user up in the database, returning the entry"""
+        if face_data is None:
+            with self._lock:
+                self._missing[user_id] = time.monotonic()
+            return None
+        self.add_document(face_data)
+        return self._entries.get(user_id)
+
+    def _drop(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return False
+        if entry['faceHash'] and self._hashes.get(entry['faceHash']) == user_id:
+            del self._hashes[entry['faceHash']]
+        return True
+
+    def _snapshot(self):
+        """Return the stacked matrices, rebuilding them if a write happened"""
+        with self._lock:
+            if self._dirty:
+                entries = list(self._entries.values())
+                if entries:
+                    self._matrix = np.concatenate([e['features'] for e in entries])
+                    self._owners = np.concatenate([np.full(len(e['features']), i, dtype=np.int64)
+                                                   for i, e in enumerate(entries)])
+                    self._variation_ids = np.concatenate([e['variationIds'] for e in entries])
+                else:
+                    self._matrix = self._empty_matrix()
+                    self._owners = np.empty(0, dtype=np.int64)
+                    self._variation_ids = np.empty(0, dtype=np.int64)
+                self._coarse = self.engine.coarse(self._matrix).astype(np.float32)
+                self._indexed = entries
+                self._positions = {e['userId']: i for i, e in enumerate(entries)}
+                self._hash_only = [e for e in entries if not len(e['features']) and e['faceHash']]
+                self._phash_entries = [e for e in entries if e['phash'] is not None]
+                codes = [e['phash'] for e in self._phash_entries]
+                self._phash_codes = (np.stack(codes).astype(np.uint64) if codes
+                                     else np.empty((0, PHASH_WORDS), dtype=np.uint64))
+                self._dirty = False
+            return (self._matrix, self._coarse, self._owners, self._variation_ids,
+                    self._indexed, self._positions, self._hash_only)
+
+    def screen(self, phash, k=None, max_distance=None):
+        """Find the faces whose perceptual hash is closest to a probe hash
+
+        Returns [(entry, Hamming distance)] sorted by distance: the k closest
+        faces, or every face within max_distance bits. Faces without a hash
+        are not screened.
+        """
+        self._snapshot()
+        with self._lock:
+            codes, entries = self._phash_codes, self._phash_entries
+        if not len(codes):
+            return []
+        distances = hamming_distances(phash, codes)
+        if max_distance is not None:
+            rows = np.flatnonzero(distances <= max_distance)
+        else:
+            rows = np.arange(len(distances))
+        k = len(rows) if k is None else min(k, len(rows))
+        if k == 0:
+            return []
+        if k < len(rows):
+            rows = rows[np.argpartition(distances[rows], k - 1)[:k]]
+        rows = rows[np.argsort(distances[rows], kind='stable')]
+        return [(entries[row], int(distances[row])) for row in rows]
+
+    def match(self, probe, image_hash, user_id=None, phash=None):
+        """Find the best matching entry for a probe embedding
+
+        Returns (entry, similarity, variation index); entry is None when
+        nothing is registered. image_hash may be None to compare features
+        only. phash, the probe's packed perceptual hash, is used by the
+        hash prefilter of the cascade.
+        """
+        if user_id is not None:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None, 0, -1
+            if image_hash is not None and entry['faceHash'] == image_hash:
+                return entry, 1.0, -1
+            if len(entry['features']):
+                scores = self.engine.similarity(probe, entry['features'])
+                best = int(np.argmax(scores))
+                return entry, float(scores[best]), int(entry['variationIds'][best])
+            if image_hash is not None and entry['faceHash']:
+                return entry, hash_similarity(entry['faceHash'], image_hash), -1
+            return entry, 0, -1
+
+        # Perfect hash match short-circuits the comparison
+        hash_owner = self._hashes.get(image_hash) if image_hash is not None else None
+        if hash_owner in self._entries:
+            return self._entries[hash_owner], 1.0, -1
+
+        matrix, coarse, owners, variation_ids, entries, positions, hash_only = self._snapshot()
+        if not entries:
+            return None, 0, -1
+
+        best_entry = None
+        best_similarity = 0
+        best_variation = -1
+
+        if len(matrix):
+            if self.top_k and len(entries) > self.top_k:
+                candidates = self._candidates(probe, phash, self.top_k, self.prefilter,
+                                              coarse, owners, entries, positions)
+                rows = np.flatnonzero(np.isin(owners, candidates))
+                scores = self.engine.similarity(probe, matrix[rows])
+                best = int(rows[np.argmax(scores)])
+                best_similarity = float(scores.max())
+                self._audit(probe, matrix, owners, best)
+            else:
+                scores = self.engine.similarity(probe, matrix)
+                best = int(np.argmax(scores))
+                best_similarity = float(scores[best])
+            best_entry = entries[owners[best]]
+            best_variation = int(variation_ids[best])
+
+        # Faces without usable images fall back to hash comparison
+        for entry in hash_only if image_hash is not None else []:
+            similarity = hash_similarity(entry['faceHash'], image_hash)
+            if similarity > best_similarity:
+                best_entry, best_similarity, best_variation = entry, similarity, -1
+
+        return best_entry, best_similarity, best_variation
+
+    def _candidates(self, probe, phash, k, prefilter, coarse, owners, entries, positions):
+        """Positions of the faces the first cascade stage ranks closest to a probe
+
+        The hash stage returns the k faces with features closest by
+        perceptual hash, plus the k closest by the lowres stage among faces
+        stored without a hash. When no face with features has a hash (as
+        with the face_recognition engine), the lowres stage is used alone.
+        """
+        with_rows = np.zeros(len(entries), dtype=bool)
+        with_rows[owners] = True
+        if prefilter == 'hash' and phash is not None:
+            hashed = [positions[entry['userId']] for entry, _ in self.screen(phash)
+                      if entry['userId'] in positions and with_rows[positions[entry['userId']]]][:k]
+            if hashed:
+                unhashed = with_rows & np.array([entry['phash'] is None for entry in entries])
+                if not unhashed.any():
+                    return np.array(hashed, dtype=np.int64)
+                per_face = self._coarse_distances(probe, coarse, owners, len(entries))
+                per_face[~unhashed] = np.inf
+                count = min(k, int(unhashed.sum()))
+                return np.concatenate([np.array(hashed, dtype=np.int64),
+                                       np.argpartition(per_face, count - 1)[:count]])
+
+        per_face = self._coarse_distances(probe, coarse, owners, len(entries))
+        k = min(k, len(entries))
+        return np.argpartition(per_face, k - 1)[:k]
+
+    def _coarse_distances(self, probe, coarse, owners, count):
+        """Mean absolute difference of the coarse embeddings, best variation per face"""
+        distances = np.abs(coarse - self.engine.coarse(probe)).reshape(len(coarse), -1).mean(axis=1)
+        per_face = np.full(count, np.inf)
+        np.minimum.at(per_face, owners, distances)
+        return per_face
+
+    def _audit(self, probe, matrix, owners, best):
+        """Occasionally check a cascaded match against the exhaustive comparison"""
+        with self._lock:
+            self._cascade_matches += 1
+        if random.random() >= self.audit_rate:
+            return
+        exhaustive_best = int(np.argmax(self.engine.similarity(probe, matrix)))
+        with self._lock:
+            self._audited += 1
+            self._audit_hits += int(owners[exhaustive_best] == owners[best])
+
+    def cascade_recall(self, probes, phashes=None, k=None, prefilter=None):
+        """Fraction of probes for which the cascade finds the exhaustive best face
+
+        Used to pick a top K for a gallery offline; phashes are only needed
+        for the hash prefilter.
+        """
+        k = k or self.top_k
+        prefilter = prefilter or self.prefilter
+        matrix, coarse, owners, _, entries, positions, _ = self._snapshot()
+        if not len(matrix) or not len(probes):
+            return 1.0
+
+        hits = 0
+        for i, probe in enumerate(probes):
+            phash = phashes[i] if phashes is not None else None
+            exhaustive_best = owners[int(np.argmax(self.engine.similarity(probe, matrix)))]
+            candidates = self._candidates(probe, phash, k, prefilter, coarse, owners, entries, positions)
+            hits += int(exhaustive_best in candidates)
+        return hits / len(probes)
+
+    def cascade_stats(self):
+        """Report the cascade settings and the recall measured by audits"""
+        with self._lock:
+            return {
+                'topK': self.top_k,
+                'prefilter': self.prefilter,
+                'matches': self._cascade_matches,
+                'audited': self._audited,
+                'auditHits': self._audit_hits,
+                'recall': self._audit_hits / self._audited if self._audited else None
+            }
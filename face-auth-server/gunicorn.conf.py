@@ -0,0 +1,18 @@
+import os
+from session_store import SESSION_BACKEND, serve_shared_store
+
+# Run with: gunicorn -c gunicorn.conf.py 'app_simplified:create_app()'
+bind = f"0.0.0.0:{os.getenv('PORT', 5001)}"
+workers = int(os.getenv('WEB_CONCURRENCY', os.cpu_count() or 1))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+
+def on_starting(server):
+    """Start the node-local session store before workers are forked"""
+    if SESSION_BACKEND == 'shared':
+        server.session_manager = serve_shared_store()
+
+def on_exit(server):
+    """Stop the node-local session store with the master"""
+    manager = getattr(server, 'session_manager', None)
+    if manager is not None:
+        manager.shutdown()
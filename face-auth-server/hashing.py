@@ -0,0 +1,41 @@
+import numpy as np
+from PIL import Image, ImageOps
+
+# Side of the downscaled image the perceptual hash is computed from
+PHASH_SIZE = 32
+# 1024 bits, stored as 16 packed uint64 words
+PHASH_BITS = PHASH_SIZE * PHASH_SIZE
+PHASH_WORDS = PHASH_BITS // 64
+
+# Number of set bits in every byte value, for popcount without NumPy 2
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint16)
+
+def phash_pixels(pixels):
+    """Equalize and downscale 64x64 grayscale pixels to the 32x32 hash input"""
+    image = ImageOps.equalize(Image.fromarray(pixels))
+    image = image.resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS)
+    return np.array(image)
+
+def phash_bits(small):
+    """Hash bits: whether each pixel is above the mean"""
+    small = small.flatten()
+    return small > small.mean()
+
+def pack_phash(bits):
+    """Pack 1024 hash bits into 16 uint64 words"""
+    return np.packbits(bits).view(np.uint64)
+
+def pixels_to_phash(pixels):
+    """Packed perceptual hash of 64x64 grayscale comparison pixels"""
+    return pack_phash(phash_bits(phash_pixels(pixels)))
+
+def popcount(words):
+    """Number of set bits along the last axis of a uint64 array"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    as_bytes = words.view(np.uint8)
+    return _POPCOUNT_TABLE[as_bytes].sum(axis=-1, dtype=np.int64)
+
+def hamming_distances(code, codes):
+    """Hamming distance from one packed hash to an (N, 16) matrix of packed hashes"""
+    return popcount(np.bitwise_xor(codes, code))
@@ -0,0 +1,267 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+import numpy as np
+
+# Maximum number of monitored sessions kept in memory
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', 5000))
+# Maximum memory used by session state, in bytes
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', 128 * 1024 * 1024))
+# Sessions without a frame for this long are dropped
+SESSION_TTL_SECONDS = float(os.getenv('SESSION_TTL_SECONDS', 3600))
+# Rough size of a session's bookkeeping besides its frame features
+SESSION_OVERHEAD_BYTES = 512
+# Where session state lives: memory (per process), shared (one store per
+# node, served over a local socket) or redis
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')
+# Address and key of the node-local shared store
+SESSION_SHARED_ADDRESS = os.getenv('SESSION_SHARED_ADDRESS', '127.0.0.1:5051')
+SESSION_SHARED_AUTHKEY = os.getenv('SESSION_SHARED_AUTHKEY', 'face-auth-sessions')
+# Redis server for the redis backend; local:// uses an in-process stand-in
+SESSION_REDIS_URL = os.getenv('SESSION_REDIS_URL', 'redis://localhost:6379/0')
+
+def state_size(state):
+    """Approximate memory used by one session state"""
+    features = state.get('features')
+    return SESSION_OVERHEAD_BYTES + (features.nbytes if features is not None else 0)
+
+class SessionStore:
+    """Bounded store of per-session movement state
+
+    Sessions are kept in the order they were last written, which for
+    monitoring (one write per frame) is least recently used order. LRU and
+    TTL eviction therefore only ever look at the front of the ordering.
+    Timestamps use the monotonic clock.
+    """
+
+    def __init__(self, max_entries=SESSION_MAX_ENTRIES, max_bytes=SESSION_MAX_BYTES,
+                 ttl=SESSION_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._lru_evictions = 0
+        self._ttl_evictions = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, session_id):
+        """Return a session's state, or None if it is unknown or expired"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            item = self._sessions.get(session_id)
+            if item is None:
+                return None
+            return item[1]
+
+    def put(self, session_id, state):
+        """Store a session's state, evicting old sessions to stay within bounds"""
+        now = time.monotonic()
+        size = state_size(state)
+        with self._lock:
+            previous = self._sessions.pop(session_id, None)
+            if previous is not None:
+                self._bytes -= previous[2]
+            self._sessions[session_id] = (now, state, size)
+            self._bytes += size
+
+            self._expire(now)
+            while len(self._sessions) > 1 and (len(self._sessions) > self.max_entries
+                                               or self._bytes > self.max_bytes):
+                self._evict()
+                self._lru_evictions += 1
+
+    def pop(self, session_id):
+        """Remove a session, returning its state"""
+        with self._lock:
+            item = self._sessions.pop(session_id, None)
+            if item is None:
+                return None
+            self._bytes -= item[2]
+            return item[1]
+
+    def _expire(self, now):
+        # The front of the ordering is always the least recently written session
+        while self._sessions:
+            written_at = next(iter(self._sessions.values()))[0]
+            if now - written_at <= self.ttl:
+                break
+            self._evict()
+            self._ttl_evictions += 1
+
+    def _evict(self):
+        _, (_, _, size) = self._sessions.popitem(last=False)
+        self._bytes -= size
+
+    def stats(self):
+        """Report the size of the store and its eviction counters"""
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'bytes': self._bytes,
+                'maxSessions': self.max_entries,
+                'maxBytes': self.max_bytes,
+                'ttlSeconds': self.ttl,
+                'lruEvictions': self._lru_evictions,
+                'ttlEvictions': self._ttl_evictions
+            }
+
+def encode_state(state):
+    """Serialize a session state as a JSON header followed by the raw features"""
+    features = state.get('features')
+    header = {key: value for key, value in state.items() if key != 'features'}
+    if features is not None:
+        header['featureShape'] = list(features.shape)
+        header['featureDtype'] = str(features.dtype)
+        return json.dumps(header).encode() + b'\n' + features.tobytes()
+    return json.dumps(header).encode() + b'\n'
+
+def decode_state(data):
+    """Inverse of encode_state"""
+    header, _, raw = data.partition(b'\n')
+    state = json.loads(header)
+    shape = state.pop('featureShape', None)
+    dtype = state.pop('featureDtype', None)
+    state['features'] = np.frombuffer(raw, dtype=dtype).reshape(shape) if shape else None
+    return state
+
+class SessionStoreManager(BaseManager):
+    """Serves one SessionStore to every worker process on a node"""
+
+# The store served by this process when it runs the shared store
+_shared_store = None
+
+def _get_shared_store():
+    global _shared_store
+    if _shared_store is None:
+        _shared_store = SessionStore()
+    return _shared_store
+
+SessionStoreManager.register('session_store', callable=_get_shared_store)
+
+def _parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+def serve_shared_store(address=SESSION_SHARED_ADDRESS, authkey=SESSION_SHARED_AUTHKEY):
+    """Start the node-local shared store in a background process
+
+    Called once per node, e.g. from the gunicorn master before workers fork.
+    """
+    manager = SessionStoreManager(address=_parse_address(address), authkey=authkey.encode())
+    manager.start()
+    print(f"Shared session store listening on {address}")
+    return manager
+
+def connect_shared_store(address=SESSION_SHARED_ADDRESS, authkey=SESSION_SHARED_AUTHKEY):
+    """Connect to the node-local shared store, returning a proxy with the SessionStore methods"""
+    manager = SessionStoreManager(address=_parse_address(address), authkey=authkey.encode())
+    manager.connect()
+    return manager.session_store()
+
+class LocalRedis:
+    """In-process stand-in for the subset of the Redis client used by RedisSessionStore"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+class RedisSessionStore:
+    """Session state kept in Redis, shared by every worker on every node
+
+    Expiry uses Redis key TTLs; memory limits are left to the server's
+    maxmemory policy.
+    """
+
+    def __init__(self, client=None, url=SESSION_REDIS_URL, ttl=SESSION_TTL_SECONDS, prefix='face-auth:session:'):
+        if client is None:
+            if url.startswith('local://'):
+                client = LocalRedis()
+            else:
+                # Only needed when the redis backend is used
+                import redis
+                client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, session_id):
+        """Return a session's state, or None if it is unknown or expired"""
+        data = self.client.get(self.prefix + session_id)
+        if data is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        return decode_state(data)
+
+    def put(self, session_id, state):
+        """Store a session's state, refreshing its expiry"""
+        self.client.set(self.prefix + session_id, encode_state(state), ex=max(1, int(self.ttl)))
+
+    def pop(self, session_id):
+        """Remove a session, returning its state"""
+        state = self.get(session_id)
+        self.client.delete(self.prefix + session_id)
+        return state
+
+    def stats(self):
+        """Report hit counters for this process"""
+        return {
+            'backend': 'redis',
+            'ttlSeconds': self.ttl,
+            'hits': self._hits,
+            'misses': self._misses
+        }
+
+def create_session_store(backend=SESSION_BACKEND):
+    """Create the session store selected by SESSION_BACKEND
+
+    A shared store that can't be reached fails the worker's startup: a
+    per-process store in its place would lose session state whenever a
+    session's requests reach different workers.
+    """
+    if backend == 'redis':
+        return RedisSessionStore()
+    if backend == 'shared':
+        try:
+            return connect_shared_store()
+        except Exception as e:
+            raise RuntimeError(f"Could not connect to the shared session store at {SESSION_SHARED_ADDRESS}: "
+                               f"{str(e)}") from e
+    return SessionStore()
+
+if __name__ == '__main__':
+    # Run the shared store on its own, for servers not started through gunicorn
+    manager = SessionStoreManager(address=_parse_address(SESSION_SHARED_ADDRESS),
+                                  authkey=SESSION_SHARED_AUTHKEY.encode())
+    print(f"Shared session store listening on {SESSION_SHARED_ADDRESS}")
+    manager.get_server().serve_forever()
@@ -0,0 +1,97 @@
+import os
+import threading
+
+# Frames searched only around the last face location between full-frame detections
+TRACK_FULL_FRAME_INTERVAL = int(os.getenv('TRACK_FULL_FRAME_INTERVAL', 10))
+# Margin added on every side of the last face location, as a fraction of the face size
+TRACK_MARGIN = float(os.getenv('TRACK_MARGIN', 0.5))
+# Longest side of the region of interest after downscaling, in pixels
+TRACK_ROI_SIZE = int(os.getenv('TRACK_ROI_SIZE', 160))
+# Prefix separating tracking state from movement state in the session store
+TRACK_KEY_PREFIX = 'track:'
+
+class FaceTracker:
+    """Per-session face tracking that avoids full-frame detection
+
+    Once a single face is found, following frames only search an expanded
+    box around its last location, downscaled to TRACK_ROI_SIZE. A
+    full-frame detection runs when the face is lost, when the box holds
+    more than one face, and every TRACK_FULL_FRAME_INTERVAL frames, so a
+    second face entering elsewhere in the frame is still caught.
+
+    State is kept in the session store so every worker shares it, and it
+    is evicted with the session's movement state after SESSION_TTL_SECONDS
+    without a frame.
+    """
+
+    def __init__(self, detect, store, full_frame_interval=TRACK_FULL_FRAME_INTERVAL,
+                 margin=TRACK_MARGIN, roi_size=TRACK_ROI_SIZE):
+        self.detect = detect
+        self.store = store
+        self.full_frame_interval = full_frame_interval
+        self.margin = margin
+        self.roi_size = roi_size
+        self._lock = threading.Lock()
+        self._full_detections = 0
+        self._roi_detections = 0
+        self._lost = 0
+
+    def locate(self, session_id, image):
+        """Face locations in a frame, as (top, right, bottom, left) tuples"""
+        key = TRACK_KEY_PREFIX + session_id
+        state = self.store.get(key)
+
+        if state and state.get('location') and state['framesTracked'] < self.full_frame_interval:
+            locations = self._detect_region(image, state['location'])
+            if len(locations) == 1:
+                self._count('_roi_detections')
+                self._save(key, locations[0], state['framesTracked'] + 1)
+                return locations
+            # Lost the face, or another one appeared near it
+            self._count('_lost')
+
+        locations = [tuple(int(v) for v in location) for location in self.detect(image)]
+        self._count('_full_detections')
+        self._save(key, locations[0] if len(locations) == 1 else None, 0)
+        return locations
+
+    def _detect_region(self, image, location):
+        """Detect faces in the expanded, downscaled box around a location"""
+        top, right, bottom, left = location
+        margin_y = int((bottom - top) * self.margin)
+        margin_x = int((right - left) * self.margin)
+        box = (max(left - margin_x, 0), max(top - margin_y, 0),
+               min(right + margin_x, image.width), min(bottom + margin_y, image.height))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            return []
+
+        region = image.crop(box)
+        scale = min(1.0, self.roi_size / max(region.size))
+        if scale < 1.0:
+            region = region.resize((max(1, int(region.width * scale)), max(1, int(region.height * scale))))
+
+        # Map the locations back to full-frame coordinates
+        return [(int(t / scale) + box[1], int(r / scale) + box[0], int(b / scale) + box[1], int(l / scale) + box[0])
+                for t, r, b, l in self.detect(region)]
+
+    def _save(self, key, location, frames_tracked):
+        self.store.put(key, {
+            'location': list(location) if location is not None else None,
+            'framesTracked': frames_tracked
+        })
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        """Report how many frames needed a full-frame detection"""
+        with self._lock:
+            total = self._full_detections + self._roi_detections
+            return {
+                'fullFrameInterval': self.full_frame_interval,
+                'fullDetections': self._full_detections,
+                'roiDetections': self._roi_detections,
+                'lost': self._lost,
+                'roiRate': self._roi_detections / total if total else None
+            }